@@ -0,0 +1,338 @@
+"""Нагрузочный прогон обработчиков бота без Telegram.
+
+Создаёт во временной папке Data.json, Orders.json, Заказы.xlsx и меню заданного размера, подменяет
+Bot API заглушкой и прогоняет настоящие обработчики из mm.py так, как их вызывал бы обед в час пик:
+N пользователей одновременно выбирают дату, добавляют блюдо, открывают корзину, оставляют комментарий
+и оформляют заказ, а администратор смотрит список заказов.
+
+    python bench.py --users 50 --rounds 5 --history 20000 --output bench_results.json
+    python bench.py --compare bench_results.json
+
+Результат — задержки p50/p95/p99 по каждому обработчику, обновлений в секунду и байты, прочитанные
+и записанные процессом (по /proc/self/io).
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DAYS_OF_WEEK = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+ADMIN_CHAT_ID = 1
+FIRST_USER_CHAT_ID = 1000
+
+
+def seed_files(workdir, registered, cart_rows, history_rows):
+    """Создаёт файлы данных бота заданного размера."""
+    from openpyxl import Workbook
+
+    addresses = [f"БЦ Тестовый {i}" for i in range(20)]
+    users = [{
+        "phone": "79000000000",
+        "role": "Администратор",
+        "address": addresses[0],
+        "name": "Администратор",
+        "chat_id": ADMIN_CHAT_ID,
+    }]
+    for i in range(registered):
+        users.append({
+            "phone": f"79{i:09d}",
+            "role": "Заказчик",
+            "address": addresses[i % len(addresses)],
+            "name": f"Пользователь {i}",
+            "chat_id": FIRST_USER_CHAT_ID + i,
+        })
+    with open(os.path.join(workdir, "Data.json"), "w", encoding="utf-8") as f:
+        json.dump({"users": users}, f, ensure_ascii=False, indent=4)
+    with open(os.path.join(workdir, "Addresses.json"), "w", encoding="utf-8") as f:
+        json.dump({"addresses": addresses}, f, ensure_ascii=False, indent=4)
+
+    dishes = ["Комплексный обед", "Морс", "Компот", "Цезарь с курицей", "Цезарь с сёмгой"]
+    today = datetime.now()
+    orders = []
+    for i in range(cart_rows):
+        user = users[1 + i % registered]
+        day = today + timedelta(days=1 + i % 6)
+        orders.append({
+            "Номер телефона": user["phone"],
+            "Дата": day.strftime("%d.%m.%Y"),
+            "День недели": DAYS_OF_WEEK[day.weekday()],
+            "Обед": dishes[i % len(dishes)],
+            "Цена": 100,
+            "Статус оплаты": "Не оплачено",
+            "Адрес доставки": user["address"],
+            "Имя заказчика": user["name"],
+        })
+    with open(os.path.join(workdir, "Orders.json"), "w", encoding="utf-8") as f:
+        json.dump(orders, f, ensure_ascii=False, indent=4)
+
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    sheet.append([
+        "Номер телефона", "Дата", "Обед", "Цена", "Статус оплаты",
+        "День недели", "Адрес доставки", "Имя заказчика", "order_id", "Комментарий"
+    ])
+    for i in range(history_rows):
+        user = users[1 + i % registered]
+        day = today - timedelta(days=i % 180)
+        sheet.append([
+            user["phone"], day.strftime("%d.%m.%Y"), dishes[i % len(dishes)], 100, "Картой",
+            DAYS_OF_WEEK[day.weekday()], user["address"], user["name"], f"order-{i // 3}", "Без комментария"
+        ])
+    wb.save(os.path.join(workdir, "Заказы.xlsx"))
+
+    menu_path = os.path.join(workdir, "Menu.csv")
+    with open(menu_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Неделя", "День недели", "Название", "Блюдо", "Цена"])
+        for week in (0, 1):
+            for day_name in DAYS_OF_WEEK:
+                for dish in ("Борщ", "Котлета с пюре", "Хлеб"):
+                    writer.writerow([week, day_name, "Комплексный обед", dish, 350])
+                writer.writerow([week, day_name, "Напиток", "Морс", 80])
+                writer.writerow([week, day_name, "Напиток", "Компот", 70])
+                writer.writerow([week, day_name, "Салат", "Цезарь с курицей", 250])
+    return menu_path
+
+
+def io_counters():
+    """Байты, прочитанные и записанные процессом (rchar/wchar); на системах без /proc — нули."""
+    try:
+        with open("/proc/self/io", "r") as f:
+            values = dict(line.split(":") for line in f.read().splitlines())
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def make_stub_bot(api_latency):
+    from telegram.ext import ExtBot
+
+    class StubBot(ExtBot):
+        """Bot, который не ходит в сеть: отвечает на вызовы Bot API как Telegram, с задержкой api_latency."""
+
+        message_id = 0
+
+        async def _do_post(self, endpoint, data, **kwargs):
+            if api_latency:
+                await asyncio.sleep(api_latency)
+            if endpoint in ("answerCallbackQuery", "setMyCommands", "deleteWebhook"):
+                return True
+            StubBot.message_id += 1
+            return {
+                "message_id": StubBot.message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(data.get("chat_id", 0) or 0), "type": "private"},
+                "text": str(data.get("text", "")),
+            }
+
+    bot = StubBot("123456:BENCHMARK")
+    bot._bot_user = None
+    return bot
+
+
+class Bench:
+    def __init__(self, mm, application):
+        self.mm = mm
+        self.application = application
+        self.bot = application.bot
+        self.update_id = 0
+        self.latencies = {}
+
+    def _message(self, chat_id, text=None):
+        message = {
+            "message_id": self.update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        }
+        if text is not None:
+            message["text"] = text
+        return message
+
+    def message_update(self, chat_id, text):
+        from telegram import Update
+
+        self.update_id += 1
+        return Update.de_json({"update_id": self.update_id, "message": self._message(chat_id, text)}, self.bot)
+
+    def callback_update(self, chat_id, data):
+        from telegram import Update
+
+        self.update_id += 1
+        return Update.de_json({
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id),
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": self._message(chat_id, "Выберите дату 📆:"),
+            },
+        }, self.bot)
+
+    def context(self, update):
+        from telegram.ext import CallbackContext
+
+        return CallbackContext.from_update(update, self.application)
+
+    async def timed(self, name, coroutine):
+        started = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+    async def call(self, name, handler, update, *args):
+        return await self.timed(name, handler(update, self.context(update), *args))
+
+    async def customer(self, chat_id, rounds, order_date):
+        mm = self.mm
+        await self.call("start", mm.start, self.message_update(chat_id, "/start"))
+        for _ in range(rounds):
+            await self.call("handle_menu_and_lunch", mm.handle_menu_and_lunch, self.callback_update(chat_id, order_date))
+            dish = random.choice(["Морс", "Компот", "Цезарь с курицей", "Комплексный обед"])
+            await self.call("handle_dish", mm.handle_dish, self.message_update(chat_id, dish), dish)
+            await self.call("show_cart", mm.show_cart, self.message_update(chat_id, "Корзина 🗑"))
+            await self.call(
+                "handle_comment", mm.handle_comment, self.message_update(chat_id, "Пропустить комментарий")
+            )
+            phone = self.application.user_data[chat_id].get("phone_number")
+            await self.timed("move_orders_to_excel", mm.move_orders_to_excel(phone, "Наличными"))
+
+    async def admin(self, rounds):
+        mm = self.mm
+        await self.call("start", mm.start, self.message_update(ADMIN_CHAT_ID, "/start"))
+        for _ in range(rounds):
+            await self.call("show_all_orders", mm.show_all_orders, self.message_update(ADMIN_CHAT_ID, "Список заказов"))
+            await asyncio.sleep(0)
+
+
+async def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bot_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    print(f"Seeding {workdir}: {args.registered} users, {args.cart} cart rows, {args.history} history rows")
+    menu_path = seed_files(workdir, args.registered, args.cart, args.history)
+
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    logging.getLogger("mm").setLevel(logging.ERROR)
+    import mm
+    from telegram.ext import Application
+
+    mm.MENU = menu_path
+    application = Application.builder().bot(make_stub_bot(args.api_latency)).updater(None).build()
+    bench = Bench(mm, application)
+
+    read_before, written_before = io_counters()
+    started = time.perf_counter()
+    await bench.timed("startup", mm.run_io(mm.get_db))
+    await bench.timed("startup", mm.run_io(mm.refresh_menu_data, True))
+
+    # Первый день, на который ещё принимаются заказы: после CUTOFF_TIME завтра уже закрыто,
+    # и прогон измерял бы только отказ «приём заказов закрыт»
+    order_day = datetime.now() + timedelta(days=1)
+    while mm.is_date_closed(order_day):
+        order_day += timedelta(days=1)
+    order_date = order_day.strftime("%d.%m.%Y")
+    users = [FIRST_USER_CHAT_ID + i for i in range(min(args.users, args.registered))]
+    await asyncio.gather(
+        bench.admin(args.rounds),
+        *(bench.customer(chat_id, args.rounds, order_date) for chat_id in users)
+    )
+    elapsed = time.perf_counter() - started
+    read_after, written_after = io_counters()
+    mm._io_executor.shutdown(wait=True)
+
+    calls = sum(len(values) for name, values in bench.latencies.items() if name != "startup")
+    handlers = {}
+    for name, values in sorted(bench.latencies.items()):
+        handlers[name] = {
+            "calls": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "max_ms": round(max(values) * 1000, 2),
+        }
+    try:
+        commit = subprocess.run(
+            ["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "config": {
+            "users": len(users),
+            "rounds": args.rounds,
+            "registered": args.registered,
+            "cart": args.cart,
+            "history": args.history,
+            "api_latency": args.api_latency,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "updates": calls,
+        "updates_per_s": round(calls / elapsed, 1) if elapsed else None,
+        "bytes_read": read_after - read_before,
+        "bytes_written": written_after - written_before,
+        "handlers": handlers,
+    }
+
+
+def print_report(result, previous=None):
+    print(f"\n{result['updates']} updates in {result['elapsed_s']} s: {result['updates_per_s']} updates/s, "
+          f"read {result['bytes_read']:,} B, written {result['bytes_written']:,} B")
+    print(f"{'handler':<24}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}" + ("  p95 vs prev" if previous else ""))
+    for name, stats in result["handlers"].items():
+        line = f"{name:<24}{stats['calls']:>7}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+        if previous and name in previous["handlers"]:
+            before = previous["handlers"][name]["p95_ms"]
+            if before:
+                line += f"  {(stats['p95_ms'] - before) / before * 100:+.0f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="одновременных пользователей")
+    parser.add_argument("--rounds", type=int, default=5, help="заказов на пользователя")
+    parser.add_argument("--registered", type=int, default=1000, help="пользователей в Data.json")
+    parser.add_argument("--cart", type=int, default=2000, help="строк в Orders.json")
+    parser.add_argument("--history", type=int, default=20000, help="строк в Заказы.xlsx")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, секунды")
+    parser.add_argument("--workdir", help="папка для данных (по умолчанию временная)")
+    parser.add_argument("--output", default=os.path.join(REPO_DIR, "bench_results.json"))
+    parser.add_argument("--compare", help="файл с прошлым результатом для сравнения")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+
+    result = asyncio.run(run(args))
+    print_report(result, previous)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=4)
+    print(f"\nSaved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
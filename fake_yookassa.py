@@ -0,0 +1,121 @@
+"""Локальная замена YooKassa для проверки оплаты без сети.
+
+Бот использует её, если задан YOOKASSA_FAKE=1. Платежи хранятся в fake_payments.json,
+поэтому статус можно менять из другого процесса:
+
+    python fake_yookassa.py list
+    python fake_yookassa.py succeed <payment_id> [url]
+    python fake_yookassa.py cancel <payment_id> [url]
+
+Если указан url (например http://127.0.0.1:8080/yookassa), после смены статуса туда отправляется
+уведомление в формате YooKassa, как это сделал бы настоящий сервис.
+"""
+import json
+import os
+import sys
+import threading
+import urllib.request
+import uuid
+from types import SimpleNamespace
+
+FAKE_PAYMENTS_FILE = os.getenv("FAKE_PAYMENTS_FILE", "fake_payments.json")
+
+
+class FakePaymentAPI:
+    """Повторяет Payment.create / Payment.find_one из SDK YooKassa в объёме, который нужен боту."""
+
+    def __init__(self, path=FAKE_PAYMENTS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.find_calls = 0
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save(self, payments):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payments, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _to_object(payment):
+        return SimpleNamespace(
+            id=payment["id"],
+            status=payment["status"],
+            amount=SimpleNamespace(**payment["amount"]),
+            description=payment.get("description"),
+            confirmation=SimpleNamespace(confirmation_url=f"https://fake-yookassa.local/pay/{payment['id']}"),
+        )
+
+    def create(self, params, idempotency_key=None):
+        with self.lock:
+            payments = self._load()
+            payment = {
+                "id": str(uuid.uuid4()),
+                "status": "pending",
+                "amount": params["amount"],
+                "description": params.get("description"),
+            }
+            payments[payment["id"]] = payment
+            self._save(payments)
+        return self._to_object(payment)
+
+    def find_one(self, payment_id):
+        with self.lock:
+            self.find_calls += 1
+            payments = self._load()
+        if payment_id not in payments:
+            raise KeyError(f"Payment {payment_id} not found")
+        return self._to_object(payments[payment_id])
+
+    def set_status(self, payment_id, status):
+        with self.lock:
+            payments = self._load()
+            payments[payment_id]["status"] = status
+            self._save(payments)
+        return self._to_object(payments[payment_id])
+
+
+def notify(url, payment):
+    """Отправляет уведомление payment.succeeded / payment.canceled на адрес бота."""
+    notification = {
+        "type": "notification",
+        "event": f"payment.{payment.status}",
+        "object": {
+            "id": payment.id,
+            "status": payment.status,
+            "amount": vars(payment.amount),
+            "description": payment.description,
+        },
+    }
+    request = urllib.request.Request(
+        url, data=json.dumps(notification).encode("utf-8"), headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status, response.read().decode("utf-8")
+
+
+def main(argv):
+    api = FakePaymentAPI()
+    if len(argv) < 2 or argv[1] not in ("list", "succeed", "cancel"):
+        print(__doc__)
+        return 1
+    if argv[1] == "list":
+        for payment in api._load().values():
+            print(f"{payment['id']}  {payment['status']}  {payment['amount']['value']} {payment['amount']['currency']}")
+        return 0
+    status = "succeeded" if argv[1] == "succeed" else "canceled"
+    payment = api.set_status(argv[2], status)
+    print(f"{payment.id}: {payment.status}")
+    if len(argv) > 3:
+        code, body = notify(argv[3], payment)
+        print(f"notification: {code} {body}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,8 +1,24 @@
 import asyncio
+import contextlib
+import contextvars
+import csv
+import functools
+import hashlib
+import heapq
+import hmac
+import ipaddress
+import io
+import queue
+import threading
+import urllib.error
+import urllib.request
 import emoji
 from openpyxl import load_workbook
 import json
 import logging
+import multiprocessing
+import signal
+import sqlite3
 import pandas as pd
 from openpyxl.workbook import Workbook
 from telegram import (
@@ -10,13 +26,24 @@ from telegram import (
 )
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler,
-    CallbackContext
+    CallbackContext, BasePersistence, PersistenceInput, TypeHandler, BaseUpdateProcessor, BaseRateLimiter, ExtBot
 )
+from telegram.constants import MessageLimit
+from telegram.request import HTTPXRequest
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
 from datetime import datetime, time, timedelta, date
 from yookassa import Configuration, Payment, payment
 import uuid
 import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from time import monotonic
+from types import SimpleNamespace
 from dotenv import load_dotenv
+try:
+    import fcntl
+except ImportError:  # Windows: несколько процессов-обработчиков там не запускаются, блокировка файлов не нужна
+    fcntl = None
 
 # Load environment variables
 load_dotenv()
@@ -30,18 +57,258 @@ CARD_NUMBER = os.getenv('CARD_NUMBER')
 # YooKassa settings
 Configuration.configure(account_id=YOOKASSA_ACCOUNT_ID, secret_key=YOOKASSA_SECRET_KEY)
 
+# Всё общение с YooKassa идёт через payment_api; при YOOKASSA_FAKE=1 — через локальную заглушку
+if os.getenv('YOOKASSA_FAKE') == '1':
+    from fake_yookassa import FakePaymentAPI
+    payment_api = FakePaymentAPI()
+else:
+    payment_api = Payment
+
 # Constants
 DATA_FILE = "Data.json"
 ORDERS = "Заказы.xlsx"
 MENU = "https://docs.google.com/spreadsheets/d/1eEEHGwtSV2znQDGJcgGVEQ2PzNTLoDPOT-9vtyQCoQY/export?format=csv"
 ADDRESSES_FILE = "Addresses.json"
 ORDERS_JSON = "Orders.json"
+CART_ARCHIVE = "Orders.archive.jsonl"  # корзины, удалённые по истечении даты
+DB_FILE = "Bot.db"
+EXPORT_DIR = "exports"
+EXPORT_CHUNK_ROWS = 50000  # строк в одном файле выгрузки
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 16))  # 1 — обновления обрабатываются строго по одному
+CHAT_BACKLOG_LIMIT = 20  # сколько обновлений одного чата может ждать очереди; остальные отбрасываются
+UPDATES_IN_FLIGHT = 1024  # сколько обновлений всего может быть принято в работу (выполняются и ждут)
+SESSION_FLUSH_INTERVAL = 30  # секунды между сохранениями context.user_data
+SESSION_FLUSH_DELAY = 1  # изменения, пришедшие за это время, пишутся одной транзакцией
+SESSION_WARM_DAYS = 14  # при старте в память загружаются только сессии, активные за эти дни
+MENU_SNAPSHOT = "Menu_snapshot.csv"
+MENU_TTL = int(os.getenv('MENU_TTL', 300))  # секунды между фоновыми проверками меню
+MENU_FETCH_TIMEOUT = 15
+MENU_RETRY_MIN = 5  # секунды до повторной загрузки меню после ошибки; удваивается с каждой ошибкой, но не больше MENU_TTL
+IO_WORKERS = int(os.getenv('IO_WORKERS', 4))
+BROADCAST_CONCURRENCY = 10
+BROADCAST_MAX_RETRIES = 3  # попытки при сетевых ошибках; темп и повторы после RetryAfter — в OutgoingRateLimiter
+BROADCAST_PROGRESS_BATCH = 50  # сколько результатов копить перед записью прогресса в базу
+BROADCAST_LEASE = 60  # секунды, на которые процесс забирает рассылку; продлевается, пока рассылка идёт
+OUTGOING_RATE = int(os.getenv('OUTGOING_RATE', 30))  # запросов отправки в секунду на весь бот (делится между процессами)
+OUTGOING_PER_CHAT_INTERVAL = float(os.getenv('OUTGOING_PER_CHAT_INTERVAL', 0.3))  # секунды между сообщениями в один чат
+OUTGOING_MAX_RETRIES = 3
+CUTOFF_TIME = time.fromisoformat(os.getenv('CUTOFF_TIME', '20:00'))  # после этого времени заказы на закрываемый день не принимаются
+CUTOFF_DAYS_AHEAD = int(os.getenv('CUTOFF_DAYS_AHEAD', 1))  # 1 — в CUTOFF_TIME закрывается завтрашний день (отчёт кухне готов заранее), 0 — сегодняшний
+CUTOFF_CART_POLICY = os.getenv('CUTOFF_CART_POLICY', 'expire')  # expire — удалить неоплаченные корзины, convert — оформить их заказом
+CART_SWEEP_INTERVAL = 3600  # секунды между чистками просроченных корзин
+VACUUM_FREE_RATIO = 0.25  # VACUUM выполняется, только если свободные страницы занимают больше этой доли базы
+PAYMENT_TIMEOUT = 600  # секунды ожидания оплаты, после которых платёж считается отменённым
+PAYMENT_POLL_MIN = 5  # первая проверка статуса через столько секунд
+PAYMENT_POLL_MAX = 60
+PAYMENT_POLL_BACKOFF = 1.5
+PAYMENT_CONCURRENCY = 4  # одновременных запросов к YooKassa
+PAYMENT_FALLBACK_POLL_MIN = 60  # при включённых уведомлениях опрос нужен только на случай потерянного уведомления
+# UPDATES_MODE=webhook — обновления Telegram приходят на встроенный HTTP-сервер вместо run_polling.
+# TELEGRAM_WEBHOOK_URL — внешний адрес (обычно за обратным прокси), который регистрируется в Telegram;
+# без него webhook не регистрируется, и обновления можно присылать вручную:
+#   curl -H "X-Telegram-Bot-Api-Secret-Token: $TELEGRAM_WEBHOOK_SECRET" --data @update.json http://127.0.0.1:8080/telegram
+UPDATES_MODE = os.getenv('UPDATES_MODE', 'polling')
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', '/telegram')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()[:32]
+TELEGRAM_WEBHOOK_CONNECTIONS = int(os.getenv('TELEGRAM_WEBHOOK_CONNECTIONS', 40))  # одновременных соединений от Telegram
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))  # при заполненной очереди webhook отвечает 503
+# WORKERS > 1 — обновления принимает процесс-диспетчер и раздаёт их процессам-обработчикам по chat_id;
+# все обработчики работают с общими Bot.db, Data.json и Addresses.json
+WORKERS = int(os.getenv('WORKERS', 1))
+WORKER_INDEX = None  # номер процесса-обработчика; None — обычный запуск одним процессом
+HTTP_HOST = os.getenv('HTTP_HOST', '127.0.0.1')
+HTTP_PORT = int(os.getenv('HTTP_PORT', 8080 if UPDATES_MODE == 'webhook' else 0))  # 0 — встроенный HTTP-сервер не запускается
+HTTP_TRUST_PROXY = os.getenv('HTTP_TRUST_PROXY') == '1'  # брать адрес клиента из X-Forwarded-For (последний адрес, его добавляет прокси)
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_READ_TIMEOUT = 30  # секунды на чтение запроса; простаивающее соединение закрывается
+METRICS_PUBLIC = os.getenv('METRICS_PUBLIC') == '1'  # отдавать /metrics не только на локальные адреса
+YOOKASSA_WEBHOOK_PATH = "/yookassa"
+# YOOKASSA_WEBHOOK=1 — уведомления YooKassa настроены и доходят до YOOKASSA_WEBHOOK_PATH,
+# поэтому платежи опрашиваются редко (PAYMENT_FALLBACK_POLL_MIN); иначе опрос идёт с PAYMENT_POLL_MIN
+YOOKASSA_WEBHOOK = os.getenv('YOOKASSA_WEBHOOK') == '1'
+YOOKASSA_CHECK_IP = os.getenv('YOOKASSA_CHECK_IP', '0' if os.getenv('YOOKASSA_FAKE') == '1' else '1') == '1'
+# Адреса, с которых YooKassa присылает уведомления (https://yookassa.ru/developers/using-api/webhooks)
+YOOKASSA_NETWORKS = [ipaddress.ip_network(net) for net in (
+    "185.71.76.0/27", "185.71.77.0/27", "77.75.153.0/25", "77.75.156.11/32",
+    "77.75.156.35/32", "77.75.154.128/25", "2a02:5180::/32",
+)]
 
 #logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def worker_for_chat(chat_id):
+    return int(chat_id) % WORKERS
+
+def owns_chat(chat_id):
+    """Обслуживает ли этот процесс чат chat_id (при запуске одним процессом — любой)."""
+    return WORKER_INDEX is None or chat_id is None or worker_for_chat(chat_id) == WORKER_INDEX
+
+DAYS_OF_WEEK = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+
 CHOOSE_ADDRESS, ENTER_NAME, BROADCAST_MESSAGE, ADD_ADDRESS, ENTER_PHONE, SELECT_ROLE, ENTER_COMMENT = range(7)
 
+# Метрики: гистограммы задержек и счётчики вызовов, ошибок и байтов. Отдаются в формате Prometheus
+# по адресу /metrics встроенного HTTP-сервера, краткая сводка — командой /stats
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_HELP = {
+    "bot_handler_seconds": "Time spent in a Telegram update handler",
+    "bot_handler_errors_total": "Exceptions raised out of a Telegram update handler",
+    "bot_storage_seconds": "Time spent in a storage operation (JSON files, SQLite, exports)",
+    "bot_storage_errors_total": "Failed storage operations",
+    "bot_storage_bytes_total": "Bytes read or written by storage operations",
+    "bot_external_seconds": "Time spent in calls to external services (menu sheet, YooKassa)",
+    "bot_external_errors_total": "Failed calls to external services",
+    "bot_external_bytes_total": "Bytes received from external services",
+    "bot_log_errors_total": "Log records at ERROR level and above",
+    "bot_webhook_updates_total": "Updates accepted on the Telegram webhook",
+    "bot_webhook_rejected_total": "Updates rejected with 503 because the update queue was full",
+    "bot_updates_dropped_total": "Updates dropped because their chat already had CHAT_BACKLOG_LIMIT updates queued",
+    "bot_cart_expired_total": "Cart entries removed because their date was closed",
+    "bot_storage_reclaimed_bytes_total": "Bytes of the main database file freed by VACUUM after cart sweeps",
+    "bot_dispatched_total": "Updates and notifications forwarded by the dispatcher to a worker process",
+    "bot_send_seconds": "Time to send a Bot API request, including waiting for a rate limit slot",
+    "bot_send_errors_total": "Bot API requests that failed after retries",
+    "bot_send_retries_total": "Bot API requests retried after a RetryAfter (flood limit) error",
+    "bot_replies_coalesced_total": "Replies merged into the next message to the same chat",
+}
+
+_metrics_lock = threading.Lock()
+_histograms = {}  # (имя, метки) -> {"buckets": [...], "sum": ..., "count": ...}; buckets не накопительные
+_counters = {}
+_gauges = {}  # имя -> (описание, функция)
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+def observe(name, seconds, **labels):
+    key = (name, _labels_key(labels))
+    with _metrics_lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": [0] * len(METRICS_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+                break
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+def inc(name, value=1, **labels):
+    key = (name, _labels_key(labels))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def register_gauge(name, help_text, func):
+    """Значение gauge вычисляется при каждом чтении метрик."""
+    _gauges[name] = (help_text, func)
+
+@contextlib.contextmanager
+def timed(metric, **labels):
+    """Пишет время выполнения блока в {metric}_seconds, исключения — в {metric}_errors_total."""
+    started = monotonic()
+    try:
+        yield
+    except Exception:
+        inc(f"{metric}_errors_total", **labels)
+        raise
+    finally:
+        observe(f"{metric}_seconds", monotonic() - started, **labels)
+
+def instrumented(metric, **labels):
+    """То же, что timed, в виде декоратора для обычных и async-функций."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with timed(metric, **labels):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with timed(metric, **labels):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def external_call(service, op, func, *args, **kwargs):
+    """Вызов внешнего сервиса с замером времени; выполняется в пуле через run_io."""
+    with timed("bot_external", service=service, op=op):
+        return func(*args, **kwargs)
+
+def count_bytes(op, direction, size):
+    inc("bot_storage_bytes_total", size, op=op, direction=direction)
+
+class _ErrorLogCounter(logging.Filter):
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            inc("bot_log_errors_total", level=record.levelname)
+        return True
+
+logger.addFilter(_ErrorLogCounter())
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in items) + "}"
+
+def _metrics_snapshot():
+    with _metrics_lock:
+        histograms = {key: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                      for key, h in _histograms.items()}
+        counters = dict(_counters)
+    gauges = {}
+    for name, (_, func) in list(_gauges.items()):
+        try:
+            gauges[name] = func()
+        except Exception as e:
+            logger.warning(f"Gauge {name} failed: {e}")
+    return histograms, counters, gauges
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus."""
+    histograms, counters, gauges = _metrics_snapshot()
+    lines = []
+    described = set()
+
+    def describe(name, kind, help_text):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), hist in sorted(histograms.items()):
+        describe(name, "histogram", METRICS_HELP.get(name, name))
+        cumulative = 0
+        for bound, count in zip(METRICS_BUCKETS, hist["buckets"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {hist['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {hist['sum']:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+    for (name, labels), value in sorted(counters.items()):
+        describe(name, "counter", METRICS_HELP.get(name, name))
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for name, value in sorted(gauges.items()):
+        describe(name, "gauge", _gauges[name][0])
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def histogram_quantile(hist, q):
+    """Оценка квантиля по корзинам гистограммы: верхняя граница корзины, в которую он попадает."""
+    target = hist["count"] * q
+    cumulative = 0
+    for bound, count in zip(METRICS_BUCKETS, hist["buckets"]):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return float("inf")
+
+@instrumented("bot_storage", op="load_data")
 def load_data(file_path, default):
     try:
         if not os.path.exists(file_path):
@@ -50,6 +317,7 @@ def load_data(file_path, default):
             
         with open(file_path, "r", encoding="utf-8") as file:
             data = json.load(file)
+            count_bytes("load_data", "read", os.fstat(file.fileno()).st_size)
             return data
     except json.JSONDecodeError as e:
         logger.error(f"JSON decode error in {file_path}: {e}")
@@ -58,38 +326,1300 @@ def load_data(file_path, default):
         logger.error(f"Error loading data from {file_path}: {e}")
         return default
 
+@instrumented("bot_storage", op="save_data")
 def save_data(file_path, data):
     try:
-        with open(file_path, "w", encoding="utf-8") as file:
+        # Пишем во временный файл и подменяем, чтобы при сбое не остался наполовину записанный JSON
+        tmp_path = f"{file_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
             json.dump(data, file, ensure_ascii=False, indent=4)
+            count_bytes("save_data", "write", file.tell())
+        os.replace(tmp_path, file_path)
     except Exception as e:
         logger.error(f"Error saving data to {file_path}: {e}")
         raise
 
+@contextlib.contextmanager
+def file_lock(path):
+    """Блокировка файла между процессами (через {path}.lock) для чтения-изменения-записи JSON-файлов.
+    Внутри процесса операции с файлом по-прежнему упорядочиваются через lock= у run_io, чтобы ожидание
+    блокировки не занимало потоки пула."""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+# Блокирующие операции (файлы, база, pandas, openpyxl, сеть) выполняются в ограниченном пуле потоков,
+# чтобы не останавливать цикл событий; операции над одним файлом идут по очереди через asyncio.Lock
+_io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+_io_locks = {}
+_io_stats_lock = threading.Lock()
+_io_stats = {
+    "submitted": 0,
+    "completed": 0,
+    "failed": 0,
+    "queued": 0,
+    "running": 0,
+    "wait_total": 0.0,
+    "wait_max": 0.0,
+    "run_total": 0.0,
+}
+
+def _io_lock(name):
+    lock = _io_locks.get(name)
+    if lock is None:
+        lock = _io_locks[name] = asyncio.Lock()
+    return lock
+
+def _run_io_job(func, args, kwargs, submitted_at):
+    started_at = monotonic()
+    wait = started_at - submitted_at
+    with _io_stats_lock:
+        _io_stats["queued"] -= 1
+        _io_stats["running"] += 1
+        _io_stats["wait_total"] += wait
+        _io_stats["wait_max"] = max(_io_stats["wait_max"], wait)
+    failed = False
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        with _io_stats_lock:
+            _io_stats["running"] -= 1
+            _io_stats["completed"] += 1
+            _io_stats["failed"] += failed
+            _io_stats["run_total"] += monotonic() - started_at
+
+async def _submit_io(func, args, kwargs):
+    with _io_stats_lock:
+        _io_stats["submitted"] += 1
+        _io_stats["queued"] += 1
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, _run_io_job, func, args, kwargs, monotonic())
+
+async def run_io(func, *args, lock=None, **kwargs):
+    """Выполняет func в пуле ввода-вывода. lock — имя файла, операции с которым нельзя выполнять параллельно."""
+    if lock is not None:
+        async with _io_lock(lock):
+            return await _submit_io(func, args, kwargs)
+    return await _submit_io(func, args, kwargs)
+
+def get_io_stats():
+    with _io_stats_lock:
+        stats = dict(_io_stats)
+    completed = stats["completed"] or 1
+    return {
+        "queued": stats["queued"],
+        "running": stats["running"],
+        "completed": stats["completed"],
+        "failed": stats["failed"],
+        "wait_avg_ms": round(stats["wait_total"] / completed * 1000, 1),
+        "wait_max_ms": round(stats["wait_max"] * 1000, 1),
+        "run_avg_ms": round(stats["run_total"] / completed * 1000, 1),
+    }
+
+register_gauge("bot_io_queued", "Jobs waiting for a free I/O worker", lambda: get_io_stats()["queued"])
+register_gauge("bot_io_running", "Jobs running in the I/O pool", lambda: get_io_stats()["running"])
+
 def load_user_data():
     return load_data(DATA_FILE, {"users": []})
 
 def save_user_data(data):
     save_data(DATA_FILE, data)
 
+# Реестр пользователей: Data.json читается один раз, поиск по chat_id и телефону — через словари,
+# изменения копятся и сбрасываются на диск пачкой (flush_user_data). Если файл изменил другой процесс,
+# реестр перечитывается (проверка mtime не чаще раза в USERS_RELOAD_INTERVAL)
+USERS_FLUSH_INTERVAL = 5  # секунды
+USERS_RELOAD_INTERVAL = 1
+
+_users = {"data": None, "by_chat": {}, "by_phone": {}, "pending": [], "mtime": None, "checked_at": 0.0}
+_users_lock = threading.RLock()
+
+def _phone_key(phone):
+    return normalize_phone_number(str(phone)) if phone else None
+
+def _index_user(user, by_chat, by_phone):
+    if user.get("chat_id") is not None:
+        by_chat[user["chat_id"]] = user
+    phone_key = _phone_key(user.get("phone"))
+    if phone_key:
+        by_phone[phone_key] = user
+
+def _load_users():
+    """Читает Data.json и добавляет к нему ещё не сохранённых пользователей этого процесса. Вызывается под _users_lock."""
+    mtime = file_mtime(DATA_FILE)
+    data = load_user_data()
+    # Индексы собираются заново и подменяются целиком: обработчики читают их из других потоков без блокировки
+    by_chat, by_phone = {}, {}
+    for user in data.get("users", []):
+        _index_user(user, by_chat, by_phone)
+    for user in _users["pending"]:
+        if _phone_key(user.get("phone")) not in by_phone:
+            data.setdefault("users", []).append(user)
+            _index_user(user, by_chat, by_phone)
+    _users.update(data=data, by_chat=by_chat, by_phone=by_phone, mtime=mtime)
+
+def _users_registry():
+    now = monotonic()
+    if _users["data"] is None or now - _users["checked_at"] >= USERS_RELOAD_INTERVAL:
+        with _users_lock:
+            if _users["data"] is None or file_mtime(DATA_FILE) != _users["mtime"]:
+                _load_users()
+            _users["checked_at"] = now
+    return _users
+
+def get_user_by_chat(chat_id):
+    return _users_registry()["by_chat"].get(chat_id)
+
+def get_user_by_phone(phone):
+    return _users_registry()["by_phone"].get(_phone_key(phone))
+
+def get_user_profile(chat_id=None, phone=None):
+    """Роль, адрес и имя пользователя по chat_id или телефону; None, если пользователь не зарегистрирован."""
+    user = get_user_by_chat(chat_id) if chat_id is not None else None
+    if user is None and phone:
+        user = get_user_by_phone(phone)
+    if user is None:
+        return None
+    return {
+        "role": user.get("role", "Заказчик"),
+        "address": user.get("address"),
+        "name": user.get("name"),
+        "phone": user.get("phone"),
+        "chat_id": user.get("chat_id"),
+    }
+
+def all_users():
+    return list(_users_registry()["data"].get("users", []))
+
+def add_user(user):
+    registry = _users_registry()
+    with _users_lock:
+        registry["data"].setdefault("users", []).append(user)
+        _index_user(user, registry["by_chat"], registry["by_phone"])
+        registry["pending"].append(user)
+
+def flush_user_data():
+    with _users_lock:
+        if not _users["pending"]:
+            return False
+        with file_lock(DATA_FILE):
+            if file_mtime(DATA_FILE) != _users["mtime"]:
+                _load_users()
+            save_user_data(_users["data"])
+            _users["mtime"] = file_mtime(DATA_FILE)
+        _users["pending"] = []
+    return True
+
+async def flush_users_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await run_io(flush_user_data, lock=DATA_FILE)
+    except Exception as e:
+        logger.error(f"Error flushing user data: {e}")
+
 def load_addresses():
     return load_data(ADDRESSES_FILE, {"addresses": []})
 
 def save_addresses(data):
     save_data(ADDRESSES_FILE, data)
 
-def load_menu_data():
+def append_address(address):
+    with file_lock(ADDRESSES_FILE):
+        addresses = load_addresses()
+        addresses["addresses"].append(address)
+        save_addresses(addresses)
+    # Клавиатуры пересоберутся при следующем обращении; другие процессы заметят новый mtime
+    with _addresses_lock:
+        _addresses["loaded"] = False
+
+# Реестр адресов доставки: у каждого адреса постоянный короткий id (от содержимого, а не от hash(),
+# который меняется между процессами), по id адрес находится без данных пользователя. Клавиатура выбора
+# собирается постранично один раз и пересобирается только при изменении Addresses.json
+ADDRESSES_PAGE_SIZE = 8
+ADDRESS_BUTTON_LENGTH = 64
+
+_addresses = {"list": [], "by_id": {}, "pages": {}, "mtime": None, "checked_at": 0.0, "loaded": False}
+_addresses_lock = threading.RLock()
+
+def address_id(address):
+    return hashlib.sha1(str(address).encode("utf-8")).hexdigest()[:8]
+
+def _load_address_registry():
+    """Читает Addresses.json и строит индекс id -> адрес. Вызывается под _addresses_lock."""
+    mtime = file_mtime(ADDRESSES_FILE)
+    entries, by_id = [], {}
+    for address in load_addresses().get("addresses", []):
+        address = str(address)
+        key = address_id(address)
+        if key in by_id:
+            if by_id[key] != address:
+                logger.warning(f"Address id collision for {key}: {address!r} skipped")
+            continue
+        by_id[key] = address
+        entries.append((key, address))
+    _addresses.update(list=entries, by_id=by_id, pages={}, mtime=mtime, loaded=True)
+
+def _address_registry():
+    now = monotonic()
+    if not _addresses["loaded"] or now - _addresses["checked_at"] >= USERS_RELOAD_INTERVAL:
+        with _addresses_lock:
+            if not _addresses["loaded"] or file_mtime(ADDRESSES_FILE) != _addresses["mtime"]:
+                _load_address_registry()
+            _addresses["checked_at"] = now
+    return _addresses
+
+def get_address(key):
+    return _address_registry()["by_id"].get(key)
+
+def address_keyboard(page=0):
+    """Страница клавиатуры выбора адреса; None, если адресов нет. Готовые страницы берутся из кэша."""
+    registry = _address_registry()
+    entries = registry["list"]
+    if not entries:
+        return None
+    pages = max((len(entries) + ADDRESSES_PAGE_SIZE - 1) // ADDRESSES_PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+    markup = registry["pages"].get(page)
+    if markup is None:
+        start = page * ADDRESSES_PAGE_SIZE
+        keyboard = [
+            [InlineKeyboardButton(address[:ADDRESS_BUTTON_LENGTH], callback_data=f"addr_{key}")]
+            for key, address in entries[start:start + ADDRESSES_PAGE_SIZE]
+        ]
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("◀️", callback_data=f"addrpage_{page - 1}"))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton("▶️", callback_data=f"addrpage_{page + 1}"))
+        if navigation:
+            keyboard.append(navigation)
+        markup = InlineKeyboardMarkup(keyboard)
+        registry["pages"][page] = markup
+    return markup
+
+# Кэш меню: таблица скачивается один раз и обновляется в фоне, обработчики читают только снимок в памяти
+_menu_cache = {
+    "data": None,
+    "etag": None,
+    "last_modified": None,
+    "digest": None,
+    "checked_at": None,
+    "version": 0,
+    "failures": 0,
+}
+_menu_lock = threading.Lock()
+
+@instrumented("bot_external", service="menu", op="fetch")
+def _fetch_menu(etag=None, last_modified=None):
+    """Скачивает CSV меню. Возвращает (содержимое, etag, last_modified); содержимое None — меню не изменилось."""
+    if not MENU.startswith(("http://", "https://")):
+        with open(MENU, "rb") as f:
+            content = f.read()
+        inc("bot_external_bytes_total", len(content), service="menu")
+        return content, None, None
+
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    request = urllib.request.Request(MENU, headers=headers)
     try:
-        if not os.path.exists(MENU):
-            logger.error("Menu file does not exist")
-            return None
-            
-        df = pd.read_csv(MENU)
-        return df
+        with urllib.request.urlopen(request, timeout=MENU_FETCH_TIMEOUT) as response:
+            content = response.read()
+            inc("bot_external_bytes_total", len(content), service="menu")
+            return content, response.headers.get("ETag"), response.headers.get("Last-Modified")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, etag, last_modified
+        raise
+
+def _load_menu_snapshot():
+    if not os.path.exists(MENU_SNAPSHOT):
+        return None
+    try:
+        return pd.read_csv(MENU_SNAPSHOT)
     except Exception as e:
-        logger.error(f"Error loading menu: {e}")
+        logger.error(f"Error loading menu snapshot: {e}")
+        return None
+
+def refresh_menu_data(force=False):
+    """Обновляет кэш меню: условным запросом по ETag/Last-Modified, а при force — полной загрузкой.
+    Как часто обновлять, решают вызывающие (refresh_menu_job раз в MENU_TTL), поэтому TTL здесь не проверяется:
+    время проверки берётся после ожидания очереди и блокировки, и сравнение с ним пропускало бы плановые обновления.
+    При ошибке сети остаётся последний удачный снимок."""
+    with _menu_lock:
+        cache = _menu_cache
+        now = datetime.now()
+        try:
+            if force:
+                content, etag, last_modified = _fetch_menu()
+            else:
+                content, etag, last_modified = _fetch_menu(cache["etag"], cache["last_modified"])
+            cache["checked_at"] = now
+            cache["failures"] = 0
+            cache["etag"] = etag
+            cache["last_modified"] = last_modified
+            if content is None:
+                return cache["data"]
+
+            digest = hashlib.sha1(content).hexdigest()
+            if digest == cache["digest"] and cache["data"] is not None:
+                return cache["data"]
+
+            with timed("bot_storage", op="menu_parse"):
+                df = pd.read_csv(io.BytesIO(content))
+            cache["data"] = df
+            cache["digest"] = digest
+            cache["version"] += 1
+            logger.info(f"Menu loaded: {len(df)} rows, version {cache['version']}")
+            try:
+                tmp_path = f"{MENU_SNAPSHOT}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, MENU_SNAPSHOT)
+            except Exception as e:
+                logger.error(f"Error saving menu snapshot: {e}")
+        except Exception as e:
+            logger.error(f"Error loading menu: {e}")
+            cache["failures"] += 1
+            if cache["data"] is None:
+                df = _load_menu_snapshot()
+                if df is not None:
+                    cache["data"] = df
+                    cache["version"] += 1
+                    logger.warning("Using menu snapshot from disk")
+        return cache["data"]
+
+def load_menu_data():
+    """Возвращает текущий снимок меню или None, если он ещё не загружен. В сеть не ходит: меню загружают
+    только post_init, refresh_menu_job и /refresh_menu, чтобы обработчики не ждали таблицу."""
+    return _menu_cache["data"]
+
+# Индекс меню: (чётность недели, день недели) -> готовый текст, клавиатуры и цены. Пересобирается при смене версии меню
+_menu_index = {"version": None, "days": {}, "dish_buttons": frozenset()}
+_menu_index_lock = threading.Lock()
+
+def _menu_price(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
         return None
 
+# Категории, которые заказываются целиком (кнопка — название категории); в остальных кнопка на каждое блюдо
+MENU_SET_CATEGORIES = {"Комплексный обед"}
+
+def _dish_buttons(daily_menu):
+    """Кнопки блюд на день: по строке на категорию в порядке таблицы."""
+    rows = []
+    for category in daily_menu['Название'].unique().tolist():
+        if category in MENU_SET_CATEGORIES:
+            rows.append([str(category)])
+        else:
+            dishes = daily_menu[daily_menu['Название'] == category]['Блюдо'].unique().tolist()
+            rows.append([str(dish) for dish in dishes])
+    return rows
+
+def build_menu_index(menu_data):
+    days = {}
+    for (week, day_name), daily_menu in menu_data.groupby(['Неделя', 'День недели'], sort=False):
+        lunch_items = daily_menu.groupby('Название').agg({'Блюдо': list, 'Цена': 'first'}).reset_index()
+
+        menu_text = ""
+        for _, row in lunch_items.iterrows():
+            menu_text += f"*{row['Название']}* ({row['Цена']} рублей):\n"
+            for i, dish in enumerate(row['Блюдо']):
+                menu_text += f"{i+1}. {dish}\n"
+            menu_text += "\n"
+
+        prices = {}
+        for _, row in lunch_items.iterrows():
+            price = _menu_price(row['Цена'])
+            if price is not None:
+                prices[str(row['Название'])] = price
+        for dish, price in zip(daily_menu['Блюдо'], daily_menu['Цена']):
+            price = _menu_price(price)
+            if price is not None:
+                prices.setdefault(str(dish), price)
+
+        buttons = _dish_buttons(daily_menu)
+        rows = [[KeyboardButton(text) for text in row] for row in buttons]
+        days[(int(week), day_name)] = {
+            "text": menu_text,
+            "keyboard": ReplyKeyboardMarkup(
+                rows + [[KeyboardButton("Назад 🔙")], [KeyboardButton("Корзина 🗑")],
+                        [KeyboardButton("Отменить заказы на эту дату")]],
+                resize_keyboard=True, one_time_keyboard=False
+            ),
+            "order_keyboard": ReplyKeyboardMarkup(
+                rows + [[KeyboardButton("Нет, спасибо")]],
+                resize_keyboard=True, one_time_keyboard=True
+            ),
+            "prices": prices,
+            "buttons": {text for row in buttons for text in row},
+        }
+    return days
+
+def get_menu_index():
+    menu_data = load_menu_data()
+    if menu_data is None:
+        return None
+    version = _menu_cache["version"]
+    if _menu_index["version"] != version:
+        with _menu_index_lock:
+            if _menu_index["version"] != version:
+                days = build_menu_index(menu_data)
+                _menu_index["days"] = days
+                _menu_index["dish_buttons"] = frozenset(text for day in days.values() for text in day["buttons"])
+                _menu_index["version"] = version
+    return _menu_index["days"]
+
+def is_dish_button(text):
+    """Есть ли такая кнопка блюда хоть в одном дне текущего меню."""
+    return get_menu_index() is not None and text in _menu_index["dish_buttons"]
+
+def get_daily_menu(selected_date):
+    """Запись индекса меню на дату ('дд.мм.гггг' или datetime) или None, если меню на этот день нет."""
+    if isinstance(selected_date, str):
+        selected_date = datetime.strptime(selected_date, '%d.%m.%Y')
+    days = get_menu_index()
+    if not days:
+        return None
+    week_number = selected_date.isocalendar()[1] % 2
+    return days.get((week_number, DAYS_OF_WEEK[selected_date.weekday()]))
+
+def schedule_menu_retry(job_queue):
+    """После неудачной загрузки меню повторяет её раньше MENU_TTL, с растущей паузой."""
+    failures = _menu_cache["failures"]
+    if failures and not job_queue.get_jobs_by_name("menu_retry"):
+        delay = min(MENU_RETRY_MIN * 2 ** (failures - 1), MENU_TTL)
+        job_queue.run_once(refresh_menu_job, when=delay, name="menu_retry")
+
+async def refresh_menu_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_io(refresh_menu_data, lock=MENU)
+    await run_io(get_menu_index)
+    schedule_menu_retry(context.job_queue)
+
+async def refresh_menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get("role") != "Администратор":
+        await update.message.reply_text("У вас нет прав для использования этой функции.")
+        return
+
+    menu_data = await run_io(refresh_menu_data, True, lock=MENU)
+    await run_io(get_menu_index)
+    if menu_data is None:
+        await update.message.reply_text("Не удалось загрузить меню.")
+        return
+    await update.message.reply_text(
+        f"Меню обновлено: {len(menu_data)} позиций (версия {_menu_cache['version']})."
+    )
+
+# Корзины хранятся в SQLite (WAL): добавление блюда — одна вставка, а не перезапись всего Orders.json
+_db_local = threading.local()
+_db_init_lock = threading.Lock()
+_db_initialized = False
+
+# Ключи заказа в старом формате Orders.json; нужны только для переноса старых корзин
+CART_FIELDS = {
+    "Номер телефона": "phone",
+    "Дата": "date",
+    "День недели": "day_name",
+    "Обед": "dish",
+    "Цена": "price",
+    "Статус оплаты": "status",
+    "Адрес доставки": "address",
+    "Имя заказчика": "name",
+    "Комментарий": "comment",
+}
+
+STATUS_UNPAID = "Не оплачено"
+# Версия строкового формата OrderRecord.encode (первое поле строки); при изменении полей увеличивается
+ORDER_RECORD_VERSION = 1
+# Версия схемы Bot.db (PRAGMA user_version), см. _upgrade_schema
+DB_SCHEMA_VERSION = 1
+
+def normalize_status(status):
+    """Статус оплаты с заглавной буквы ("не оплачено" -> "Не оплачено"); пустой статус — не оплачено."""
+    status = str(status or "").strip()
+    return status[:1].upper() + status[1:] if status else STATUS_UNPAID
+
+@dataclass(slots=True)
+class OrderRecord:
+    """Одна позиция корзины или заказа: дата хранится порядковым номером дня, цена — целыми рублями.
+    Один тип для корзины, оформления заказа и отчётов вместо словарей с ключами из Orders.json."""
+    phone: str
+    date_ord: int
+    dish: str
+    price: int
+    day_name: str | None = None
+    status: str = STATUS_UNPAID
+    address: str | None = None
+    name: str | None = None
+    comment: str | None = None
+    id: int | None = None
+
+    def __post_init__(self):
+        self.phone = str(self.phone).strip()
+        self.price = int(self.price or 0)
+        self.status = normalize_status(self.status)
+
+    @property
+    def date(self):
+        return date.fromordinal(self.date_ord).strftime('%d.%m.%Y')
+
+    @classmethod
+    def from_row(cls, row):
+        """Из строки таблицы cart или order_history."""
+        return cls(
+            row["phone"], row["date_ord"], row["dish"], row["price"], row["day_name"],
+            row["status"], row["address"], row["name"], row["comment"], row["id"]
+        )
+
+    @classmethod
+    def from_dict(cls, order):
+        """Из заказа в старом формате Orders.json."""
+        fields = {column: order.get(key) for key, column in CART_FIELDS.items()}
+        return cls(
+            fields["phone"], _date_ordinal(fields["date"]), fields["dish"], fields["price"], fields["day_name"],
+            fields["status"], fields["address"], fields["name"], fields["comment"]
+        )
+
+    def cart_params(self):
+        return (
+            self.phone, self.date_ord, self.day_name, self.dish, self.price,
+            self.status, self.address, self.name, self.comment,
+        )
+
+    def history_params(self, order_id, created_at):
+        """Строка order_history: телефон там хранится только цифрами, дата — ещё и текстом для выгрузок."""
+        return (
+            order_id, ''.join(filter(str.isdigit, self.phone)), self.date, self.date_ord,
+            self.dish or "", self.price, self.status, self.day_name or "", self.address or "",
+            self.name or "", self.comment or "Без комментария", created_at,
+        )
+
+    def export_row(self, order_id):
+        """Строка выгрузки истории: те же колонки, что раньше писал move_orders_to_excel."""
+        return [
+            self.phone, self.date, self.dish, self.price, self.status,
+            self.day_name, self.address, self.name, order_id, self.comment or "Без комментария",
+        ]
+
+    def encode(self):
+        """Компактная строка без отступов и длинных ключей: версия формата и поля по порядку."""
+        return json.dumps([
+            ORDER_RECORD_VERSION, self.phone, self.date_ord, self.dish, self.price, self.day_name,
+            self.status, self.address, self.name, self.comment, self.id,
+        ], ensure_ascii=False, separators=(",", ":"))
+
+def _create_schema(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS cart (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone TEXT NOT NULL,
+            date_ord INTEGER NOT NULL,
+            day_name TEXT,
+            dish TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            status TEXT,
+            address TEXT,
+            name TEXT,
+            comment TEXT
+        );
+        CREATE INDEX IF NOT EXISTS cart_phone_date ON cart (phone, date_ord);
+        CREATE INDEX IF NOT EXISTS cart_date ON cart (date_ord);
+        CREATE TABLE IF NOT EXISTS order_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            date TEXT NOT NULL,
+            date_ord INTEGER NOT NULL,
+            dish TEXT,
+            price INTEGER,
+            status TEXT,
+            day_name TEXT,
+            address TEXT,
+            name TEXT,
+            comment TEXT,
+            created_at TEXT,
+            cancelled_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS history_date ON order_history (date_ord);
+        CREATE INDEX IF NOT EXISTS history_phone_date ON order_history (phone, date_ord);
+        CREATE INDEX IF NOT EXISTS history_order_id ON order_history (order_id);
+        CREATE TABLE IF NOT EXISTS kitchen_totals (
+            date_ord INTEGER NOT NULL,
+            address TEXT NOT NULL,
+            dish TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (date_ord, address, dish)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS cart_headers (
+            phone TEXT PRIMARY KEY,
+            comment TEXT,
+            items INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS cart_day_totals (
+            phone TEXT NOT NULL,
+            date_ord INTEGER NOT NULL,
+            day_name TEXT,
+            dishes TEXT NOT NULL DEFAULT '',
+            items INTEGER NOT NULL DEFAULT 0,
+            subtotal INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (phone, date_ord)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS kitchen_reports (
+            date_ord INTEGER PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            totals TEXT NOT NULL,
+            expired INTEGER NOT NULL DEFAULT 0,
+            converted INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,
+            phone TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            amount INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TEXT NOT NULL,
+            finished_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS payments_status ON payments (status);
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at);
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, key)
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            admin_chat_id INTEGER,
+            created_at TEXT,
+            finished_at TEXT,
+            owner INTEGER,
+            lease_until REAL
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_targets (
+            broadcast_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (broadcast_id, chat_id)
+        );
+    """)
+    _ensure_column(conn, "order_history", "cancelled_at", "TEXT")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS history_active ON order_history (phone, date_ord, order_id) "
+        "WHERE cancelled_at IS NULL"
+    )
+
+def _upgrade_schema(conn):
+    """Доводит данные до DB_SCHEMA_VERSION; каждая ступень выполняется один раз."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= DB_SCHEMA_VERSION:
+        return
+    with conn:
+        if version < 1:
+            # Старые обработчики писали статус и с маленькой буквы ("не оплачено"); lower() в SQLite
+            # не работает с кириллицей, поэтому статусы сравниваются в Python
+            for table in ("cart", "order_history"):
+                for (status,) in conn.execute(f"SELECT DISTINCT status FROM {table}").fetchall():
+                    if normalize_status(status) != status:
+                        conn.execute(
+                            f"UPDATE {table} SET status = ? WHERE status IS ?", (normalize_status(status), status)
+                        )
+        conn.execute(f"PRAGMA user_version = {DB_SCHEMA_VERSION}")
+
+def _ensure_column(conn, table, column, declaration):
+    """Добавляет колонку в таблицу, созданную более ранней версией бота."""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+def _date_ordinal(date_str):
+    return datetime.strptime(date_str, '%d.%m.%Y').toordinal()
+
+def _insert_cart_rows(conn, records):
+    conn.executemany(
+        "INSERT INTO cart (phone, date_ord, day_name, dish, price, status, address, name, comment) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [record.cart_params() for record in records]
+    )
+
+def _migrate_orders_json(conn):
+    """Однократно переносит корзины из Orders.json в базу."""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'orders_json_migrated'").fetchone():
+        return
+    orders = load_data(ORDERS_JSON, []) if os.path.exists(ORDERS_JSON) else []
+    if not isinstance(orders, list):
+        orders = []
+    valid = []
+    for order in orders:
+        # Одна испорченная запись не должна мешать переносу остальных: иначе get_db() падал бы при каждом вызове
+        try:
+            if order.get("Номер телефона") and order.get("Дата") and order.get("Обед"):
+                valid.append(OrderRecord.from_dict(order))
+        except (AttributeError, TypeError, ValueError) as e:
+            logger.warning(f"Skipping malformed cart entry in {ORDERS_JSON}: {order!r} ({e})")
+    with conn:
+        _insert_cart_rows(conn, valid)
+        conn.execute("INSERT INTO meta (key, value) VALUES ('orders_json_migrated', ?)", (datetime.now().isoformat(),))
+    if orders:
+        logger.info(f"Migrated {len(valid)} of {len(orders)} cart entries from {ORDERS_JSON}")
+
+ORDER_HISTORY_COLUMNS = [
+    "Номер телефона", "Дата", "Обед", "Цена", "Статус оплаты",
+    "День недели", "Адрес доставки", "Имя заказчика", "order_id", "Комментарий"
+]
+
+def _migrate_orders_xlsx(conn):
+    """Однократно переносит историю заказов из Заказы.xlsx в базу."""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'orders_xlsx_migrated'").fetchone():
+        return
+    rows = []
+    if os.path.exists(ORDERS):
+        wb = load_workbook(ORDERS, read_only=True)
+        sheet = wb.worksheets[0]
+        header = None
+        for values in sheet.iter_rows(values_only=True):
+            if header is None:
+                header = [str(v).strip() if v is not None else "" for v in values]
+                continue
+            record = dict(zip(header, values))
+            if not any(value not in (None, "") for value in values):
+                continue
+            # Строка с испорченной датой или ценой пропускается: иначе get_db() падал бы при каждом вызове
+            try:
+                phone = ''.join(filter(str.isdigit, str(record.get("Номер телефона") or "")))
+                date_value = record.get("Дата")
+                if isinstance(date_value, date):
+                    date_value = date_value.strftime('%d.%m.%Y')
+                date_ord = _date_ordinal(str(date_value).strip())
+                price = record.get("Цена")
+                price = int(float(price)) if price not in (None, "") else None
+            except (TypeError, ValueError, OverflowError) as e:
+                logger.warning(f"Skipping malformed row in {ORDERS}: {values!r} ({e})")
+                continue
+            rows.append((
+                str(record.get("order_id") or ""), phone, str(date_value).strip(), date_ord,
+                record.get("Обед"), price,
+                record.get("Статус оплаты"), record.get("День недели"), record.get("Адрес доставки"),
+                record.get("Имя заказчика"), record.get("Комментарий"), None
+            ))
+        wb.close()
+    with conn:
+        _insert_history_rows(conn, rows)
+        conn.execute("INSERT INTO meta (key, value) VALUES ('orders_xlsx_migrated', ?)", (datetime.now().isoformat(),))
+    if rows:
+        logger.info(f"Migrated {len(rows)} orders from {ORDERS}")
+
+def _insert_history_rows(conn, rows):
+    conn.executemany(
+        "INSERT INTO order_history (order_id, phone, date, date_ord, dish, price, status, day_name, address, name, comment, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+
+def _update_kitchen_totals(conn, items, delta):
+    """Меняет счётчики блюд по дате и адресу; items — тройки (date_ord, address, dish)."""
+    conn.executemany(
+        "INSERT INTO kitchen_totals (date_ord, address, dish, count) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (date_ord, address, dish) DO UPDATE SET count = count + excluded.count",
+        [(date_ord, address or "", dish or "", delta) for date_ord, address, dish in items]
+    )
+    if delta < 0:
+        conn.execute("DELETE FROM kitchen_totals WHERE count <= 0")
+
+def _bump_history_version(conn):
+    """Версия истории заказов меняется при каждой записи; по ней кэшируются выгрузки."""
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES ('history_version', '1') "
+        "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+    )
+
+def _history_version(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'history_version'").fetchone()
+    return int(row["value"]) if row else 0
+
+def _build_kitchen_totals(conn):
+    """Однократно считает счётчики по уже накопленной истории заказов."""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'kitchen_totals_built'").fetchone():
+        return
+    with conn:
+        conn.execute("DELETE FROM kitchen_totals")
+        conn.execute(
+            "INSERT INTO kitchen_totals (date_ord, address, dish, count) "
+            "SELECT date_ord, COALESCE(address, ''), COALESCE(dish, ''), COUNT(*) FROM order_history "
+            "WHERE cancelled_at IS NULL GROUP BY date_ord, COALESCE(address, ''), COALESCE(dish, '')"
+        )
+        conn.execute("INSERT INTO meta (key, value) VALUES ('kitchen_totals_built', ?)", (datetime.now().isoformat(),))
+
+def _cart_totals_add(conn, record):
+    """Добавляет блюдо в итоги корзины: заголовок (число блюд и сумма) и строку дня (блюда и подытог)."""
+    conn.execute(
+        "INSERT INTO cart_headers (phone, items, total) VALUES (?, 1, ?) "
+        "ON CONFLICT (phone) DO UPDATE SET items = items + 1, total = total + excluded.total",
+        (record.phone, record.price)
+    )
+    conn.execute(
+        "INSERT INTO cart_day_totals (phone, date_ord, day_name, dishes, items, subtotal) "
+        "VALUES (?, ?, ?, ?, 1, ?) ON CONFLICT (phone, date_ord) DO UPDATE SET "
+        "dishes = CASE WHEN dishes = '' THEN excluded.dishes ELSE dishes || ', ' || excluded.dishes END, "
+        "items = items + 1, subtotal = subtotal + excluded.subtotal, "
+        "day_name = COALESCE(excluded.day_name, day_name)",
+        (record.phone, record.date_ord, record.day_name, record.dish, record.price)
+    )
+
+def _cart_totals_recount(conn, phone, date_ords):
+    """Пересчитывает итоги корзины phone после удаления строк: только затронутые дни и заголовок.
+    Когда корзина пустеет, заголовок удаляется вместе с комментарием."""
+    for date_ord in set(date_ords):
+        row = conn.execute(
+            "SELECT MAX(day_name) AS day_name, GROUP_CONCAT(dish, ', ') AS dishes, "
+            "COUNT(*) AS items, SUM(price) AS subtotal "
+            "FROM (SELECT * FROM cart WHERE phone = ? AND date_ord = ? ORDER BY id)",
+            (phone, date_ord)
+        ).fetchone()
+        if row["items"]:
+            conn.execute(
+                "INSERT OR REPLACE INTO cart_day_totals (phone, date_ord, day_name, dishes, items, subtotal) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (phone, date_ord, row["day_name"], row["dishes"], row["items"], row["subtotal"])
+            )
+        else:
+            conn.execute("DELETE FROM cart_day_totals WHERE phone = ? AND date_ord = ?", (phone, date_ord))
+    items, total = conn.execute(
+        "SELECT COALESCE(SUM(items), 0), COALESCE(SUM(subtotal), 0) FROM cart_day_totals WHERE phone = ?", (phone,)
+    ).fetchone()
+    if items:
+        conn.execute("UPDATE cart_headers SET items = ?, total = ? WHERE phone = ?", (items, total, phone))
+    else:
+        conn.execute("DELETE FROM cart_headers WHERE phone = ?", (phone,))
+
+def _cart_rows_removed(conn, records):
+    """Обновляет итоги корзин после удаления записей records."""
+    affected = {}
+    for record in records:
+        affected.setdefault(record.phone, set()).add(record.date_ord)
+    for phone, date_ords in affected.items():
+        _cart_totals_recount(conn, phone, date_ords)
+
+def _build_cart_headers(conn):
+    """Однократно строит заголовки и итоги по дням для уже накопленных корзин."""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'cart_headers_built'").fetchone():
+        return
+    with conn:
+        conn.execute("DELETE FROM cart_day_totals")
+        conn.execute("DELETE FROM cart_headers")
+        conn.execute(
+            "INSERT INTO cart_day_totals (phone, date_ord, day_name, dishes, items, subtotal) "
+            "SELECT phone, date_ord, MAX(day_name), GROUP_CONCAT(dish, ', '), COUNT(*), SUM(price) "
+            "FROM (SELECT * FROM cart ORDER BY id) GROUP BY phone, date_ord"
+        )
+        conn.execute(
+            "INSERT INTO cart_headers (phone, comment, items, total) "
+            "SELECT phone, MAX(comment), COUNT(*), SUM(price) FROM cart GROUP BY phone"
+        )
+        conn.execute("INSERT INTO meta (key, value) VALUES ('cart_headers_built', ?)", (datetime.now().isoformat(),))
+
+def get_db():
+    """Соединение с базой для текущего потока; при первом обращении создаёт схему и переносит старые данные."""
+    global _db_initialized
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+    if not _db_initialized:
+        with _db_init_lock:
+            if not _db_initialized:
+                _create_schema(conn)
+                _upgrade_schema(conn)
+                _migrate_orders_json(conn)
+                _migrate_orders_xlsx(conn)
+                _build_kitchen_totals(conn)
+                _build_cart_headers(conn)
+                _db_initialized = True
+    return conn
+
+@instrumented("bot_storage", op="cart_add")
+def cart_add(record):
+    conn = get_db()
+    with conn:
+        cursor = conn.execute(
+            "INSERT INTO cart (phone, date_ord, day_name, dish, price, status, address, name, comment) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            record.cart_params()
+        )
+        _cart_totals_add(conn, record)
+    return cursor.lastrowid
+
+@instrumented("bot_storage", op="cart_remove")
+def cart_remove(phone, item_id):
+    conn = get_db()
+    phone = str(phone).strip()
+    with conn:
+        row = conn.execute("SELECT date_ord FROM cart WHERE id = ? AND phone = ?", (item_id, phone)).fetchone()
+        if row is None:
+            return False
+        conn.execute("DELETE FROM cart WHERE id = ?", (item_id,))
+        _cart_totals_recount(conn, phone, [row["date_ord"]])
+    return True
+
+@instrumented("bot_storage", op="cart_list")
+def cart_list(phone, date=None):
+    conn = get_db()
+    if date is None:
+        rows = conn.execute(
+            "SELECT * FROM cart WHERE phone = ? ORDER BY date_ord, id", (str(phone).strip(),)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT * FROM cart WHERE phone = ? AND date_ord = ? ORDER BY id", (str(phone).strip(), _date_ordinal(date))
+        ).fetchall()
+    return [OrderRecord.from_row(row) for row in rows]
+
+@instrumented("bot_storage", op="cart_clear")
+def cart_clear(phone):
+    conn = get_db()
+    phone = str(phone).strip()
+    with conn:
+        cursor = conn.execute("DELETE FROM cart WHERE phone = ?", (phone,))
+        conn.execute("DELETE FROM cart_day_totals WHERE phone = ?", (phone,))
+        conn.execute("DELETE FROM cart_headers WHERE phone = ?", (phone,))
+    return cursor.rowcount
+
+@instrumented("bot_storage", op="cart_set_comment")
+def cart_set_comment(phone, comment):
+    """Комментарий хранится в заголовке корзины, строки корзины не переписываются."""
+    conn = get_db()
+    with conn:
+        cursor = conn.execute("UPDATE cart_headers SET comment = ? WHERE phone = ?", (comment, str(phone).strip()))
+    return cursor.rowcount > 0
+
+@instrumented("bot_storage", op="cart_summary")
+def cart_summary(phone):
+    """Заголовок корзины с итогами по дням: {"comment", "items", "total", "days": [...]}; None, если корзина пуста."""
+    conn = get_db()
+    phone = str(phone).strip()
+    header = conn.execute("SELECT comment, items, total FROM cart_headers WHERE phone = ?", (phone,)).fetchone()
+    if header is None:
+        return None
+    days = conn.execute(
+        "SELECT date_ord, day_name, dishes, items, subtotal FROM cart_day_totals WHERE phone = ? ORDER BY date_ord",
+        (phone,)
+    ).fetchall()
+    return {
+        "comment": header["comment"],
+        "items": header["items"],
+        "total": header["total"],
+        "days": [
+            {**dict(day), "date": date.fromordinal(day["date_ord"]).strftime('%d.%m.%Y')} for day in days
+        ],
+    }
+
+class _ExportPart:
+    """Один файл выгрузки: строки пишутся потоком, в памяти весь файл не собирается."""
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        if fmt == "csv":
+            self.file = open(path, "w", newline="", encoding="utf-8-sig")
+            self.writer = csv.writer(self.file, delimiter=";")
+            self.writer.writerow(ORDER_HISTORY_COLUMNS)
+        else:
+            self.workbook = Workbook(write_only=True)
+            self.writer = self.workbook.create_sheet()
+            self.writer.append(ORDER_HISTORY_COLUMNS)
+
+    def append(self, values):
+        if self.fmt == "csv":
+            self.writer.writerow(values)
+        else:
+            self.writer.append(values)
+
+    def close(self):
+        with timed("bot_storage", op=f"export_{self.fmt}_save"):
+            if self.fmt == "csv":
+                self.file.close()
+            else:
+                self.workbook.save(self.path)
+        count_bytes(f"export_{self.fmt}_save", "write", os.path.getsize(self.path))
+
+@instrumented("bot_storage", op="export_orders")
+def export_orders(date_from=None, date_to=None, address=None, status=None, fmt="xlsx"):
+    """Выгружает историю заказов с фильтрами в один или несколько файлов по EXPORT_CHUNK_ROWS строк.
+    Колонки те же, что раньше писал move_orders_to_excel. Повторная выгрузка с теми же фильтрами
+    при неизменной истории берётся из кэша. Возвращает список путей."""
+    conn = get_db()
+    version = _history_version(conn)
+    filters = [
+        date_from.toordinal() if date_from else None,
+        date_to.toordinal() if date_to else None,
+        address, status, fmt,
+    ]
+    key = hashlib.sha1(json.dumps(filters, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+    manifest_path = os.path.join(EXPORT_DIR, f"{key}.json")
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    # Одинаковая выгрузка из двух процессов писала бы в одни и те же файлы
+    with file_lock(manifest_path):
+        manifest = load_data(manifest_path, None) if os.path.exists(manifest_path) else None
+        if manifest and manifest.get("version") == version and all(os.path.exists(path) for path in manifest["paths"]):
+            return manifest["paths"]
+
+        conditions, params = ["cancelled_at IS NULL"], []
+        if filters[0] is not None:
+            conditions.append("date_ord >= ?")
+            params.append(filters[0])
+        if filters[1] is not None:
+            conditions.append("date_ord <= ?")
+            params.append(filters[1])
+        if address:
+            conditions.append("address = ?")
+            params.append(address)
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(conditions)}"
+
+        paths = []
+        part = None
+        rows_in_part = 0
+        try:
+            for row in conn.execute(
+                "SELECT id, order_id, phone, date_ord, dish, price, status, day_name, address, name, comment "
+                f"FROM order_history {where} ORDER BY date_ord, id", params
+            ):
+                if part is None or rows_in_part >= EXPORT_CHUNK_ROWS:
+                    if part is not None:
+                        part.close()
+                    part = _ExportPart(os.path.join(EXPORT_DIR, f"{key}_{len(paths) + 1}.{fmt}"), fmt)
+                    paths.append(part.path)
+                    rows_in_part = 0
+                part.append(OrderRecord.from_row(row).export_row(row["order_id"]))
+                rows_in_part += 1
+        finally:
+            if part is not None:
+                part.close()
+
+        if manifest:
+            for path in manifest["paths"]:
+                if path not in paths and os.path.exists(path):
+                    os.remove(path)
+        save_data(manifest_path, {"version": version, "paths": paths})
+        return paths
+
+@instrumented("bot_storage", op="load_kitchen_totals")
+def load_kitchen_totals(date_ord):
+    return get_db().execute(
+        "SELECT address, dish, count FROM kitchen_totals WHERE date_ord = ? ORDER BY address, dish", (date_ord,)
+    ).fetchall()
+
+@instrumented("bot_storage", op="cancel_history_orders")
+def cancel_history_orders(phone, date, order_id=None):
+    """Отменяет заказы пользователя на дату (или только заказ order_id). Строки не удаляются, а помечаются
+    cancelled_at; поиск идёт по индексу (телефон, дата, order_id), счётчики кухни меняются в той же транзакции."""
+    phone_clean = ''.join(filter(str.isdigit, str(phone)))
+    conditions = "phone = ? AND date_ord = ? AND cancelled_at IS NULL"
+    params = [phone_clean, _date_ordinal(date)]
+    if order_id:
+        conditions += " AND order_id = ?"
+        params.append(order_id)
+    conn = get_db()
+    with conn:
+        cancelled = conn.execute(
+            f"SELECT id, date_ord, address, dish FROM order_history WHERE {conditions}", params
+        ).fetchall()
+        if not cancelled:
+            return 0
+        conn.executemany(
+            "UPDATE order_history SET cancelled_at = ? WHERE id = ?",
+            [(datetime.now().isoformat(), row["id"]) for row in cancelled]
+        )
+        _update_kitchen_totals(conn, [(row["date_ord"], row["address"], row["dish"]) for row in cancelled], -1)
+        _refresh_kitchen_reports(conn, [row["date_ord"] for row in cancelled])
+        _bump_history_version(conn)
+    return len(cancelled)
+
+def closing_date(now=None):
+    """Дата, приём заказов на которую закрывается сегодня в CUTOFF_TIME."""
+    return (now or datetime.now()).date() + timedelta(days=CUTOFF_DAYS_AHEAD)
+
+def last_closed_date(now=None):
+    """Самая поздняя дата, приём заказов на которую уже закрыт."""
+    now = now or datetime.now()
+    boundary = closing_date(now)
+    return boundary if now.time() >= CUTOFF_TIME else boundary - timedelta(days=1)
+
+def is_date_closed(day, now=None):
+    """Закрыт ли приём заказов на day (date, datetime или строка дд.мм.гггг)."""
+    now = now or datetime.now()
+    if isinstance(day, str):
+        day = datetime.strptime(day, '%d.%m.%Y').date()
+    elif isinstance(day, datetime):
+        day = day.date()
+    return day <= last_closed_date(now)
+
+def _stale_cart_rows(conn, date_ord):
+    """Корзины на даты до date_ord включительно, кроме корзин с ожидающей оплатой (их закроет PaymentWatcher)."""
+    return [OrderRecord.from_row(row) for row in conn.execute(
+        "SELECT * FROM cart WHERE date_ord <= ? "
+        "AND phone NOT IN (SELECT phone FROM payments WHERE status = 'pending') ORDER BY phone, id",
+        (date_ord,)
+    )]
+
+def _expire_cart_rows(conn, rows):
+    """Удаляет записи корзины в текущей транзакции conn. В архив они пишутся после фиксации
+    (_archive_cart_rows), чтобы неудавшаяся транзакция не оставила запись и в архиве, и в корзине."""
+    conn.executemany("DELETE FROM cart WHERE id = ?", [(record.id,) for record in rows])
+    _cart_rows_removed(conn, rows)
+
+def _archive_cart_rows(rows, reason):
+    """Дописывает удалённые записи корзины в CART_ARCHIVE: время, причина и OrderRecord.encode() через табуляцию."""
+    if not rows:
+        return
+    archived_at = datetime.now().isoformat()
+    with file_lock(CART_ARCHIVE), open(CART_ARCHIVE, "a", encoding="utf-8") as archive:
+        for record in rows:
+            archive.write(f"{archived_at}\t{reason}\t{record.encode()}\n")
+        count_bytes("cart_archive", "write", archive.tell())
+    inc("bot_cart_expired_total", len(rows), reason=reason)
+
+def _db_bytes(conn):
+    """Размер основного файла базы по страницам (без WAL)."""
+    return conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+
+@instrumented("bot_storage", op="sweep_carts")
+def sweep_carts(now=None):
+    """Убирает корзины на закрытые даты (прошедшие и сегодняшнюю после отсечки) одной транзакцией,
+    сохранив их в CART_ARCHIVE, затем сжимает WAL и, если свободного места много, саму базу.
+    Возвращает (удалено записей, байт основного файла базы, освобождённых VACUUM)."""
+    conn = get_db()
+    with conn:
+        rows = _stale_cart_rows(conn, last_closed_date(now).toordinal())
+        _expire_cart_rows(conn, rows)
+    if not rows:
+        return 0, 0
+    _archive_cart_rows(rows, "sweep")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    reclaimed = 0
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    total_pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    if total_pages and free_pages / total_pages > VACUUM_FREE_RATIO:
+        size_before = _db_bytes(conn)
+        conn.execute("VACUUM")
+        reclaimed = max(size_before - _db_bytes(conn), 0)
+        inc("bot_storage_reclaimed_bytes_total", reclaimed)
+    return len(rows), reclaimed
+
+async def sweep_carts_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        removed, reclaimed = await run_io(sweep_carts, lock=DB_FILE)
+    except Exception as e:
+        logger.error(f"Error sweeping expired carts: {e}")
+        return
+    if removed:
+        logger.info(f"Swept {removed} expired cart entries to {CART_ARCHIVE}, reclaimed {reclaimed} bytes")
+
+@instrumented("bot_storage", op="close_day")
+def close_day(date_ord, policy=None):
+    """Закрывает день date_ord одной транзакцией. Корзины на этот и прошедшие дни удаляются (policy "expire")
+    или корзины на сам день оформляются неоплаченным заказом ("convert"); корзины с ожидающей оплатой
+    не трогаются. Итоги кухни по адресам и блюдам сохраняются в kitchen_reports.
+    Возвращает отчёт или None, если день уже закрыт."""
+    policy = policy or CUTOFF_CART_POLICY
+    conn = get_db()
+    with conn:
+        if conn.execute("SELECT 1 FROM kitchen_reports WHERE date_ord = ?", (date_ord,)).fetchone():
+            return None
+        stale = _stale_cart_rows(conn, date_ord)
+
+        history = []
+        expired = stale
+        if policy == "convert":
+            converted = [record for record in stale if record.date_ord == date_ord]
+            expired = [record for record in stale if record.date_ord != date_ord]
+            carts = {}
+            for record in converted:
+                carts.setdefault(record.phone, []).append(record)
+            created_at = datetime.now().isoformat()
+            for phone, records in carts.items():
+                records = _checkout_records(
+                    records, STATUS_UNPAID, get_user_profile(phone=phone), _cart_comment(conn, phone)
+                )
+                _insert_history_records(conn, str(uuid.uuid4()), records, created_at)
+                history += records
+            if history:
+                _bump_history_version(conn)
+                conn.executemany("DELETE FROM cart WHERE id = ?", [(record.id,) for record in converted])
+                _cart_rows_removed(conn, converted)
+        # Корзины на прошедшие даты (и на закрываемый день при policy "expire") уходят в архив, как при чистке
+        _expire_cart_rows(conn, expired)
+
+        totals = [tuple(row) for row in conn.execute(
+            "SELECT address, dish, count FROM kitchen_totals WHERE date_ord = ? ORDER BY address, dish", (date_ord,)
+        )]
+        report = {
+            "date_ord": date_ord,
+            "totals": totals,
+            "expired": len(expired),
+            "converted": len(history),
+        }
+        conn.execute(
+            "INSERT INTO kitchen_reports (date_ord, created_at, totals, expired, converted) VALUES (?, ?, ?, ?, ?)",
+            (date_ord, datetime.now().isoformat(), json.dumps(totals, ensure_ascii=False),
+             report["expired"], report["converted"])
+        )
+    _archive_cart_rows(expired, "cutoff")
+    return report
+
+def _refresh_kitchen_reports(conn, date_ords):
+    """Пересчитывает сохранённые отчёты закрытых дней из date_ords по kitchen_totals. Нужно, когда после
+    отсечки проходит оплата корзины, которую отсечка оставила (ожидающий платёж), или отменяется заказ."""
+    for date_ord in set(date_ords):
+        totals = [tuple(row) for row in conn.execute(
+            "SELECT address, dish, count FROM kitchen_totals WHERE date_ord = ? ORDER BY address, dish", (date_ord,)
+        )]
+        cursor = conn.execute(
+            "UPDATE kitchen_reports SET totals = ? WHERE date_ord = ?", (json.dumps(totals, ensure_ascii=False), date_ord)
+        )
+        if cursor.rowcount:
+            logger.info(f"Kitchen report for {date.fromordinal(date_ord)} updated after cutoff")
+
+def load_kitchen_report(date_ord):
+    """Итоги закрытого дня, посчитанные при отсечке; None, если день ещё не закрыт."""
+    row = get_db().execute("SELECT totals FROM kitchen_reports WHERE date_ord = ?", (date_ord,)).fetchone()
+    return json.loads(row["totals"]) if row else None
+
 def normalize_phone_number(phone_number):
     try:
         if not phone_number:
@@ -129,11 +1659,9 @@ async def under_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        load_user_data()
-        user_data = load_user_data()
         chat_id = update.message.chat_id
         if context.user_data.get("phone_verified"):
-            user = next((u for u in user_data["users"] if u.get("chat_id") == chat_id), None)
+            user = get_user_by_chat(chat_id)
             if user:
                 keyboard = get_role_keyboard(user.get("role", "Заказчик"))
                 await update.message.reply_text(
@@ -142,7 +1670,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-        user = next((u for u in user_data["users"] if u.get("chat_id") == chat_id), None)
+        user = get_user_by_chat(chat_id)
         if user:
             context.user_data["phone_verified"] = True
             context.user_data["phone_number"] = user["phone"]
@@ -160,7 +1688,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         contact = update.message.contact
         if contact:
             phone_number = normalize_phone_number(contact.phone_number)
-            user = next((u for u in user_data["users"] if u["phone"] == phone_number), None)
+            user = get_user_by_phone(phone_number)
 
             if user:
                 context.user_data["phone_verified"] = True
@@ -175,31 +1703,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
                 )
             else:
-                addresses = load_addresses().get("addresses", [])
-                if not addresses:
+                reply_markup = await run_io(address_keyboard, 0)
+                if reply_markup is None:
                     await update.message.reply_text(
                         "Список адресов доставки недоступен. Свяжитесь с администратором."
                     )
                     return
 
                 context.user_data["phone_number"] = phone_number
-                keyboard = []
-                for address in addresses:
-                    # Convert address to string and create a unique callback data
-                    address_str = str(address)[:64]  # Limit to 64 characters
-                    callback_data = f"addr_{hash(address_str) % 10000}"  # Create shorter unique identifier
-                    keyboard.append([InlineKeyboardButton(address_str, callback_data=callback_data)])
-                
-                # Store address mapping in context
-                context.user_data["address_mapping"] = {
-                    f"addr_{hash(str(addr))% 10000}": str(addr) 
-                    for addr in addresses
-                }
-                
-                await update.message.reply_text(
-                    "Выберите адрес доставки 🏘:",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
+                await update.message.reply_text("Выберите адрес доставки 🏘:", reply_markup=reply_markup)
                 return CHOOSE_ADDRESS
         else:
             await update.message.reply_text(
@@ -221,7 +1733,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     payment_id = query.data.split("_")[2]
 
     try:
-        payment = Payment.find_one(payment_id)
+        payment = await run_io(external_call, "yookassa", "find_one", payment_api.find_one, payment_id)
         status = payment.status
         await query.edit_message_text(f'Статус платежа {payment_id}: {status}')
     except Exception as e:
@@ -238,13 +1750,19 @@ async def choose_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
 
-        # Get the actual address from the mapping
         callback_data = query.data
-        address = context.user_data["address_mapping"].get(callback_data)
-        
+        if callback_data.startswith("addrpage_"):
+            page = int(callback_data.removeprefix("addrpage_"))
+            await query.edit_message_reply_markup(reply_markup=await run_io(address_keyboard, page))
+            return CHOOSE_ADDRESS
+
+        address = get_address(callback_data.removeprefix("addr_"))
         if not address:
-            await query.edit_message_text("Ошибка: адрес не найден")
-            return
+            # Кнопка со старым или удалённым адресом: показываем актуальный список
+            await query.edit_message_text(
+                "Адрес не найден, выберите ещё раз 🏘:", reply_markup=await run_io(address_keyboard, 0)
+            )
+            return CHOOSE_ADDRESS
 
         phone_number = context.user_data.get("phone_number")
         if not phone_number:
@@ -273,15 +1791,13 @@ async def enter_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Ошибка регистрации. Попробуйте снова.")
             return ConversationHandler.END
 
-        user_data = load_user_data()
-        user_data["users"].append({
+        add_user({
             "phone": phone_number,
             "role": "Заказчик",
             "address": address,
             "name": name,
             "chat_id": update.message.chat_id
         })
-        save_user_data(user_data)
 
         await update.message.reply_text(f"Регистрация завершена. Добро пожаловать, {name}!")
         role = context.user_data.get("role", "Заказчик")
@@ -300,14 +1816,12 @@ async def enter_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     today = datetime.now()
     days = [today + timedelta(days=i) for i in range(7)]
-    cutoff_time = time(20, 00) #ТУТ МЕНЯТЬ ВРЕМЯ 10 - ЧАСЫ; 00 - МИНУТЫ!!!!!!!!!!!!!!!!!!!!!!!!!
 
     keyboard = []
-    days_of_week = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
     for day in days:
-        if day.date() == today.date() and datetime.now().time() >= cutoff_time:
+        if is_date_closed(day, today):  # время отсечки задаётся CUTOFF_TIME
             continue
-        day_name = days_of_week[day.weekday()]
+        day_name = DAYS_OF_WEEK[day.weekday()]
         button_text = f"{day.strftime('%d.%m.%Y')} ({day_name})"
         keyboard.append([InlineKeyboardButton(button_text, callback_data=day.strftime('%d.%m.%Y'))])
 
@@ -320,60 +1834,29 @@ async def handle_menu_and_lunch(update: Update, context: ContextTypes.DEFAULT_TY
         query = update.callback_query
         selected_date_str = query.data
         selected_date_full = datetime.strptime(selected_date_str, '%d.%m.%Y')
-        days_of_week = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
-        day_index = selected_date_full.weekday()
-        selected_day_name = days_of_week[day_index]
+        selected_day_name = DAYS_OF_WEEK[selected_date_full.weekday()]
 
         await query.answer()
+        if is_date_closed(selected_date_full):
+            await query.edit_message_text(f"Приём заказов на {selected_date_str} уже закрыт.")
+            return
         await query.edit_message_text(f"Вы выбрали дату 📆: {selected_date_str} ({selected_day_name})")
         context.user_data["selected_date"] = selected_date_str
         context.user_data["selected_day_name"] = selected_day_name
 
         try:
-            menu_data = pd.read_csv(MENU)
-            menu_data['Цена'] = menu_data['Цена'].astype(str) + ' рублей'
-
-            week_number = selected_date_full.isocalendar()[1] % 2
-
-            daily_menu = menu_data[(menu_data['День недели'] == selected_day_name) & (menu_data['Неделя'] == week_number)]
+            if get_menu_index() is None:
+                await query.message.reply_text("Меню временно недоступно. Попробуйте позже.")
+                return
 
-            if daily_menu.empty:
+            daily_menu = get_daily_menu(selected_date_full)
+            if daily_menu is None:
                 await query.message.reply_text("К сожалению, на эту дату нет меню.")
                 return
 
-            lunch_items = daily_menu.groupby('Название').agg({'Блюдо': list, 'Цена': 'first'}).reset_index()
-
-            menu_text = f"Меню на {selected_date_str} ({days_of_week[day_index]})\n\n"
-
-            for index, row in lunch_items.iterrows():
-                menu_text += f"*{row['Название']}* ({row['Цена']}):\n"
-                for i, dish in enumerate(row['Блюдо']):
-                    menu_text += f"{i+1}. {dish}\n"
-                menu_text += "\n"
-
+            menu_text = f"Меню на {selected_date_str} ({selected_day_name})\n\n" + daily_menu["text"]
             await query.message.reply_text(menu_text)
-
-            complex_lunches = daily_menu[daily_menu['Название'] == 'Комплексный обед']['Название'].unique().tolist()
-            drinks = daily_menu[daily_menu['Название'] == 'Напиток']['Блюдо'].unique().tolist()
-            salads = daily_menu[daily_menu['Название'] == 'Салат']['Блюдо'].unique().tolist()
-
-            keyboard = []
-            if complex_lunches:
-                row = [KeyboardButton(option) for option in complex_lunches]
-                keyboard.append(row)
-
-            if drinks:
-                row = [KeyboardButton(option) for option in drinks]
-                keyboard.append(row)
-
-            if salads:
-                row = [KeyboardButton(option) for option in salads]
-                keyboard.append(row)
-
-            keyboard.append([KeyboardButton("Назад 🔙")])
-            keyboard.append([KeyboardButton("Корзина 🗑")])
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
-            await query.message.reply_text("Выберите обед 🍜:", reply_markup=reply_markup)
+            await query.message.reply_text("Выберите обед 🍜:", reply_markup=daily_menu["keyboard"])
         except Exception as e:
             await query.message.reply_text(f"Ошибка при загрузке меню: {e}")
             return
@@ -391,155 +1874,86 @@ async def handle_menu_and_lunch(update: Update, context: ContextTypes.DEFAULT_TY
         if selected_date is None:
             await update.message.reply_text("Выберите дату, прежде чем заказывать обед.")
             return
+        if is_date_closed(selected_date):
+            await update.message.reply_text(f"Приём заказов на {selected_date} уже закрыт.")
+            return
 
         try:
-            menu_data = pd.read_csv(MENU)
-            daily_menu = menu_data[menu_data['День недели'] == selected_day_name] 
-
-            if message in daily_menu['Название'].unique():
-                complex_lunch_options = daily_menu[daily_menu['Название'] == message]
-                if not complex_lunch_options.empty:
-                    price = complex_lunch_options['Цена'].iloc[0]
-                else:
-                    await update.message.reply_text(f"Цена для {message} не найдена в меню.")
-                    return
-
-            else:
-                price_row = daily_menu[daily_menu['Блюдо'] == message]
-                if not price_row.empty:
-                    price = price_row['Цена'].iloc[0]
-                else:
-                    await update.message.reply_text(f"Цена для {message} не найдена в меню.")
-                    return
-
-
-            try:
-                with open(ORDERS_JSON, 'r', encoding='utf-8') as f:
-                    try:
-                        orders = json.load(f)
-
-                        if not isinstance(orders, list):
-                            orders = []
-                    except json.JSONDecodeError:
-
-                        orders = []
-            except FileNotFoundError:
-
-                orders = []
-
-
-            new_order = {
-                "Номер телефона": phone,
-                "Дата": selected_date,
-                "День недели": selected_day_name,
-                "Обед": message,
-                "Цена": int(price),
-            }
-            try:
-                with open(ORDERS_JSON, 'r', encoding='utf-8') as f:
-                    try:
-                        orders = json.load(f)
-                        if not isinstance(orders, list):
-                            orders = []
-                    except json.JSONDecodeError:
-                        orders = []
-            except FileNotFoundError:
-                orders = []
-
-            orders.append(new_order)
+            daily_menu = get_daily_menu(selected_date)
+            price = daily_menu["prices"].get(message) if daily_menu else None
+            if price is None:
+                await update.message.reply_text(f"Цена для {message} не найдена в меню.")
+                return
 
-            with open(ORDERS_JSON, 'w', encoding='utf-8') as f:
-                json.dump(orders, f, ensure_ascii=False, indent=4)
+            new_order = new_cart_record(phone, selected_date, selected_day_name, message, price)
+            await run_io(cart_add, new_order, lock=DB_FILE)
 
 
             await update.message.reply_text(f"Ваш выбор ({message}) записан! Цена: {price} рублей.")
 
-            daily_menu = menu_data[menu_data['День недели'] == selected_day_name]
-            complex_lunches = daily_menu[daily_menu['Название'] == 'Комплексный обед']['Название'].unique().tolist()
-            drinks = daily_menu[daily_menu['Название'] == 'Напиток']['Блюдо'].unique().tolist()
-            salads = daily_menu[daily_menu['Название'] == 'Салат']['Блюдо'].unique().tolist()
-
-            keyboard = []
-            if complex_lunches:
-                row = [KeyboardButton(option) for option in complex_lunches]
-                keyboard.append(row)
-
-            if drinks:
-                row = [KeyboardButton(option) for option in drinks]
-                keyboard.append(row)
-
-            if salads:
-                row = [KeyboardButton(option) for option in salads]
-                keyboard.append(row)
-
-            keyboard.append([KeyboardButton("Нет, спасибо")])
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-            await update.message.reply_text("Выберите ещё что-нибудь или нажмите 'Нет, спасибо':", reply_markup=reply_markup)
+            await update.message.reply_text("Выберите ещё что-нибудь или нажмите 'Нет, спасибо':", reply_markup=daily_menu["order_keyboard"])
 
         except Exception as e:
             await update.message.reply_text(f"Ошибка при записи заказа: {e}")
             return
 
-async def move_orders_to_excel(phone, payment_status="Не оплачено", orders_json_path=ORDERS_JSON, orders_excel_path=ORDERS):
-    try:
-        if not os.path.exists(orders_json_path):
-            logger.error(f"Orders JSON file does not exist: {orders_json_path}")
-            return False, None
+def new_cart_record(phone, selected_date, day_name, dish, price, profile=None):
+    """Новая позиция корзины; адрес и имя берутся из профиля пользователя."""
+    profile = profile or get_user_profile(phone=phone) or {}
+    return OrderRecord(
+        phone, _date_ordinal(selected_date), dish, price, day_name,
+        STATUS_UNPAID, profile.get("address"), profile.get("name")
+    )
+
+def _cart_comment(conn, phone):
+    row = conn.execute("SELECT comment FROM cart_headers WHERE phone = ?", (str(phone).strip(),)).fetchone()
+    return row["comment"] if row else None
+
+def _checkout_records(records, payment_status, profile=None, comment=None):
+    """Записи корзины в том виде, в каком они уходят в историю: со статусом оплаты, адресом и именем
+    (если их нет в корзине — из profile) и комментарием из заголовка корзины."""
+    profile = profile or {}
+    return [
+        replace(
+            record, status=payment_status,
+            address=record.address or profile.get("address") or "",
+            name=record.name or profile.get("name") or "",
+            comment=comment or record.comment or "Без комментария",
+        )
+        for record in records
+    ]
 
-        with open(orders_json_path, "r", encoding="utf-8") as f:
-            orders = json.load(f)
+def _insert_history_records(conn, order_id, records, created_at):
+    """Пишет оформленный заказ в order_history и в счётчики кухни в текущей транзакции conn."""
+    _insert_history_rows(conn, [record.history_params(order_id, created_at) for record in records])
+    _update_kitchen_totals(conn, [(record.date_ord, record.address, record.dish) for record in records], 1)
 
-        user_orders = [order for order in orders if str(order.get("Номер телефона")).strip() == str(phone).strip()]
-        if not user_orders:
-            logger.warning(f"No orders found for phone: {phone}")
-            return False, []
+@instrumented("bot_storage", op="move_orders_to_history")
+def _move_orders_to_history(phone, payment_status):
+    user_orders = cart_list(phone)
+    if not user_orders:
+        logger.warning(f"No orders found for phone: {phone}")
+        return False, []
 
-        order_id = str(uuid.uuid4())
+    order_id = str(uuid.uuid4())
+    conn = get_db()
+    records = _checkout_records(user_orders, payment_status, comment=_cart_comment(conn, phone))
 
-        for order in user_orders:
-            order["order_id"] = order_id
-            order["Статус оплаты"] = payment_status
-            order["Комментарий"] = order.get("Комментарий", "Без комментария")
+    with conn:
+        _insert_history_records(conn, order_id, records, datetime.now().isoformat())
+        _refresh_kitchen_reports(conn, [record.date_ord for record in user_orders])
+        _bump_history_version(conn)
+        conn.executemany("DELETE FROM cart WHERE id = ?", [(record.id,) for record in user_orders])
+        _cart_rows_removed(conn, user_orders)
 
-        try:
-            if os.path.exists(orders_excel_path):
-                wb = load_workbook(orders_excel_path)
-            else:
-                wb = Workbook()
-                sheet = wb.active
-                sheet.append([
-                    "Номер телефона", "Дата", "Обед", "Цена", "Статус оплаты",
-                    "День недели", "Адрес доставки", "Имя заказчика", "order_id", "Комментарий"
-                ])
-        except Exception as e:
-            logger.error(f"Error handling Excel file: {e}")
-            return False, None
-
-        sheet = wb.active
-        for order in user_orders:
-            sheet.append([
-                order.get("Номер телефона", ""),
-                order.get("Дата", ""),
-                order.get("Обед", ""),
-                order.get("Цена", ""),
-                order.get("Статус оплаты", ""),
-                order.get("День недели", ""),
-                order.get("Адрес доставки", ""),
-                order.get("Имя заказчика", ""),
-                order.get("order_id", ""),
-                order.get("Комментарий", "Без комментария")
-            ])
-
-        wb.save(orders_excel_path)
-
-        remaining_orders = [order for order in orders if str(order.get("Номер телефона")).strip() != str(phone).strip()]
-        with open(orders_json_path, "w", encoding="utf-8") as f:
-            json.dump(remaining_orders, f, ensure_ascii=False, indent=4)
-
-        return True, order_id
+    return True, order_id
 
+async def move_orders_to_excel(phone, payment_status=STATUS_UNPAID):
+    """Переносит корзину пользователя в историю заказов (название сохранено со времён хранения истории в Excel)."""
+    try:
+        return await run_io(_move_orders_to_history, phone, payment_status, lock=DB_FILE)
     except Exception as e:
-        logger.error(f"Error moving orders to Excel: {e}")
+        logger.error(f"Error moving orders to history: {e}")
         return False, None
 
 
@@ -556,6 +1970,333 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in menu: {e}")
         await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте снова.")
 
+class RateLimiter:
+    """Ограничивает отправку: не больше rate сообщений в секунду всего и одно сообщение в per_chat_interval на чат."""
+
+    def __init__(self, rate, per_chat_interval):
+        self.interval = 1.0 / rate
+        self.per_chat_interval = per_chat_interval
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+        self.chat_next_slot = {}
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+    async def acquire(self, chat_id=None):
+        async with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot, self.paused_until)
+            if chat_id is not None:
+                slot = max(slot, self.chat_next_slot.get(chat_id, 0.0))
+                self.chat_next_slot[chat_id] = slot + self.per_chat_interval
+            self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+# Исходящие сообщения. Все запросы к Bot API проходят через OutgoingRateLimiter: общий темп и темп по чату,
+# повтор после RetryAfter. Внутри обработчика подряд идущие ответы в один чат без клавиатуры не отправляются
+# сразу, а склеиваются со следующим ответом (ReplyBot); остаток отправляется в конце обработчика
+SEND_ENDPOINT_PREFIXES = ("send", "edit", "copy", "forward")
+
+class OutgoingRateLimiter(BaseRateLimiter):
+    """Темп отправки для всего бота поверх RateLimiter; запросы без чата (getUpdates, answerCallbackQuery) не ждут."""
+
+    def __init__(self, rate=OUTGOING_RATE, per_chat_interval=OUTGOING_PER_CHAT_INTERVAL, max_retries=OUTGOING_MAX_RETRIES):
+        self.limiter = RateLimiter(rate, per_chat_interval)
+        self.max_retries = max_retries
+        self.waiting = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        paced = endpoint.startswith(SEND_ENDPOINT_PREFIXES)
+        with timed("bot_send", method=endpoint):
+            for attempt in range(self.max_retries):
+                if paced:
+                    self.waiting += 1
+                    try:
+                        await self.limiter.acquire(data.get("chat_id"))
+                    finally:
+                        self.waiting -= 1
+                try:
+                    return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    if attempt == self.max_retries - 1:
+                        raise
+                    delay = retry_after_seconds(e)
+                    logger.warning(f"Flood limit on {endpoint}, retrying in {delay}s")
+                    inc("bot_send_retries_total", method=endpoint)
+                    self.limiter.pause(delay)
+                    if not paced:
+                        await asyncio.sleep(delay)
+
+class _ReplyBuffer:
+    """Ответы обработчика, ожидающие склейки: chat_id -> (текст, остальные параметры send_message)."""
+
+    def __init__(self):
+        self.task = asyncio.current_task()
+        self.held = {}
+
+_reply_buffer = contextvars.ContextVar("reply_buffer", default=None)
+
+class ReplyBot(ExtBot):
+    """ExtBot, который склеивает подряд идущие ответы в один чат (см. coalesce_replies)."""
+
+    def _active_buffer(self):
+        buffer = _reply_buffer.get()
+        # Задачи, запущенные из обработчика, наследуют контекст, но в чужой буфер не пишут
+        if buffer is None or buffer.task is not asyncio.current_task():
+            return None
+        return buffer
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        buffer = self._active_buffer()
+        if buffer is None or args:
+            return await super().send_message(chat_id, text, *args, **kwargs)
+        reply_markup = kwargs.pop("reply_markup", None)
+        held = buffer.held.pop(chat_id, None)
+        if held is not None:
+            held_text, held_kwargs = held
+            merged = f"{held_text}\n\n{text}"
+            if held_kwargs == kwargs and len(merged) <= MessageLimit.MAX_TEXT_LENGTH:
+                inc("bot_replies_coalesced_total")
+                text = merged
+            else:
+                await super().send_message(chat_id, held_text, **held_kwargs)
+        if reply_markup is None:
+            buffer.held[chat_id] = (text, kwargs)
+            return None
+        return await super().send_message(chat_id, text, reply_markup=reply_markup, **kwargs)
+
+    async def flush_replies(self):
+        buffer = self._active_buffer()
+        if buffer is None:
+            return
+        while buffer.held:
+            chat_id = next(iter(buffer.held))
+            text, kwargs = buffer.held.pop(chat_id)
+            await super().send_message(chat_id, text, **kwargs)
+
+    async def _do_post(self, endpoint, data, *args, **kwargs):
+        # Любой другой запрос (правка, ответ на кнопку, файл) уходит только после отложенных ответов,
+        # чтобы пользователь видел сообщения в том же порядке
+        await self.flush_replies()
+        return await super()._do_post(endpoint, data, *args, **kwargs)
+
+def coalesce_replies(callback):
+    """Обработчик с буфером ответов; ответы без клавиатуры не возвращают Message (вызов вернёт None)."""
+    @functools.wraps(callback)
+    async def wrapper(update, context, *args, **kwargs):
+        if _reply_buffer.get() is not None or not isinstance(context.bot, ReplyBot):
+            return await callback(update, context, *args, **kwargs)
+        token = _reply_buffer.set(_ReplyBuffer())
+        try:
+            return await callback(update, context, *args, **kwargs)
+        finally:
+            try:
+                await context.bot.flush_replies()
+            except Exception as e:
+                logger.error(f"Error sending buffered replies: {e}")
+            _reply_buffer.reset(token)
+    return wrapper
+
+def create_broadcast(text, admin_chat_id, chat_ids):
+    conn = get_db()
+    with conn:
+        cursor = conn.execute(
+            "INSERT INTO broadcasts (text, admin_chat_id, created_at) VALUES (?, ?, ?)",
+            (text, admin_chat_id, datetime.now().isoformat())
+        )
+        broadcast_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT OR IGNORE INTO broadcast_targets (broadcast_id, chat_id) VALUES (?, ?)",
+            [(broadcast_id, chat_id) for chat_id in chat_ids]
+        )
+    return broadcast_id
+
+def load_broadcast(broadcast_id):
+    conn = get_db()
+    broadcast = conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    pending = [
+        row["chat_id"] for row in conn.execute(
+            "SELECT chat_id FROM broadcast_targets WHERE broadcast_id = ? AND state = 'pending'", (broadcast_id,)
+        )
+    ]
+    return broadcast, pending
+
+def unfinished_broadcasts():
+    """Незавершённые рассылки, которые никто не ведёт: у владельца истекла аренда или владельца нет."""
+    return [row["id"] for row in get_db().execute(
+        "SELECT id FROM broadcasts WHERE finished_at IS NULL AND (owner IS NULL OR lease_until < ?)",
+        (datetime.now().timestamp(),)
+    )]
+
+def claim_broadcast(broadcast_id, owner):
+    """Забирает рассылку процессу owner на BROADCAST_LEASE секунд. Не получится, если её ведёт другой процесс
+    (или другая задача этого же) с действующей арендой, поэтому перезапущенный обработчик не шлёт её второй раз."""
+    now = datetime.now().timestamp()
+    conn = get_db()
+    with conn:
+        cursor = conn.execute(
+            "UPDATE broadcasts SET owner = ?, lease_until = ? "
+            "WHERE id = ? AND finished_at IS NULL AND (owner IS NULL OR lease_until < ?)",
+            (owner, now + BROADCAST_LEASE, broadcast_id, now)
+        )
+    return cursor.rowcount > 0
+
+def renew_broadcast(broadcast_id, owner):
+    conn = get_db()
+    with conn:
+        cursor = conn.execute(
+            "UPDATE broadcasts SET lease_until = ? WHERE id = ? AND owner = ? AND finished_at IS NULL",
+            (datetime.now().timestamp() + BROADCAST_LEASE, broadcast_id, owner)
+        )
+    return cursor.rowcount > 0
+
+def release_broadcast(broadcast_id, owner):
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "UPDATE broadcasts SET owner = NULL, lease_until = NULL WHERE id = ? AND owner = ?", (broadcast_id, owner)
+        )
+
+def save_broadcast_progress(broadcast_id, results):
+    conn = get_db()
+    with conn:
+        conn.executemany(
+            "UPDATE broadcast_targets SET state = ? WHERE broadcast_id = ? AND chat_id = ?",
+            [(state, broadcast_id, chat_id) for chat_id, state in results]
+        )
+
+def finish_broadcast(broadcast_id):
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE broadcasts SET finished_at = ? WHERE id = ?", (datetime.now().isoformat(), broadcast_id))
+    counts = dict(conn.execute(
+        "SELECT state, COUNT(*) FROM broadcast_targets WHERE broadcast_id = ? GROUP BY state", (broadcast_id,)
+    ).fetchall())
+    return counts.get("sent", 0), counts.get("failed", 0)
+
+async def _send_broadcast_message(bot, chat_id, text):
+    """Темп отправки и повторы после RetryAfter обеспечивает OutgoingRateLimiter бота, как для любых
+    исходящих сообщений; здесь повторяются только сетевые ошибки."""
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+            return "sent"
+        except RetryAfter as e:
+            logger.error(f"Flood limit persists, giving up on {chat_id}: {e}")
+            return "failed"
+        except (Forbidden, BadRequest) as e:
+            logger.error(f"Error sending message to {chat_id}: {e}")
+            return "failed"
+        except (TimedOut, NetworkError) as e:
+            logger.warning(f"Network error sending message to {chat_id}: {e}")
+            await asyncio.sleep(2 ** attempt)
+    return "failed"
+
+async def run_broadcast(bot, broadcast_id):
+    """Рассылает сообщение параллельно в пределах лимитов Telegram; прогресс пишется в базу, поэтому после перезапуска рассылка продолжается.
+    Рассылку ведёт процесс, который взял её в аренду (claim_broadcast); пока она идёт, аренда продлевается."""
+    owner = os.getpid()
+    if not await run_io(claim_broadcast, broadcast_id, owner, lock=DB_FILE):
+        return
+    broadcast, pending = await run_io(load_broadcast, broadcast_id)
+
+    started_at = monotonic()
+    queue = asyncio.Queue()
+    for chat_id in pending:
+        queue.put_nowait(chat_id)
+    results = []
+
+    async def flush_results():
+        batch = results[:]
+        results.clear()
+        if batch:
+            await run_io(save_broadcast_progress, broadcast_id, batch, lock=DB_FILE)
+
+    async def worker():
+        while True:
+            try:
+                chat_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            state = await _send_broadcast_message(bot, chat_id, broadcast["text"])
+            results.append((chat_id, state))
+            if len(results) >= BROADCAST_PROGRESS_BATCH:
+                await flush_results()
+
+    lease = {"lost": False}
+
+    async def keep_lease():
+        while True:
+            await asyncio.sleep(BROADCAST_LEASE / 3)
+            try:
+                renewed = await run_io(renew_broadcast, broadcast_id, owner, lock=DB_FILE)
+            except Exception as e:
+                logger.error(f"Error renewing broadcast {broadcast_id} lease: {e}")
+                continue
+            if not renewed:
+                logger.warning(f"Broadcast {broadcast_id} lease lost, stopping")
+                lease["lost"] = True
+                while not queue.empty():
+                    queue.get_nowait()
+                return
+
+    lease_task = asyncio.create_task(keep_lease())
+    finished = False
+    try:
+        try:
+            await asyncio.gather(*(worker() for _ in range(BROADCAST_CONCURRENCY)))
+        finally:
+            await flush_results()
+        if lease["lost"]:
+            return
+        delivered, failed = await run_io(finish_broadcast, broadcast_id, lock=DB_FILE)
+        finished = True
+    finally:
+        lease_task.cancel()
+        if not finished and not lease["lost"]:
+            # Остановка процесса: отдаём рассылку сразу, не дожидаясь конца аренды
+            try:
+                await run_io(release_broadcast, broadcast_id, owner, lock=DB_FILE)
+            except Exception as e:
+                logger.error(f"Error releasing broadcast {broadcast_id}: {e}")
+
+    elapsed = monotonic() - started_at
+    rate = len(pending) / elapsed if elapsed > 0 else 0
+    logger.info(f"Broadcast {broadcast_id} finished: {delivered} delivered, {failed} failed in {elapsed:.1f}s")
+    if broadcast["admin_chat_id"]:
+        try:
+            await bot.send_message(
+                chat_id=broadcast["admin_chat_id"],
+                text=(
+                    f"Рассылка завершена ✉\n"
+                    f"Доставлено: {delivered}\n"
+                    f"Не доставлено: {failed}\n"
+                    f"Время: {elapsed:.1f} с ({rate:.1f} сообщений/с)"
+                )
+            )
+        except Exception as e:
+            logger.error(f"Error sending broadcast report: {e}")
+
+async def resume_broadcasts_job(context: ContextTypes.DEFAULT_TYPE):
+    for broadcast_id in await run_io(unfinished_broadcasts):
+        logger.info(f"Resuming broadcast {broadcast_id}")
+        context.application.create_task(run_broadcast(context.bot, broadcast_id), name=f"broadcast_{broadcast_id}")
+
 async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     role = context.user_data.get("role")
     logger.info(f"Роль пользователя в broadcast_start: {role}")
@@ -570,17 +2311,17 @@ async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         message = update.message.text
-        user_data = load_user_data()
+        chat_ids = list(dict.fromkeys(user["chat_id"] for user in all_users() if user.get("chat_id")))
 
-        for user in user_data["users"]:
-            chat_id = user.get("chat_id")
-            if chat_id:
-                try:
-                    await context.bot.send_message(chat_id=chat_id, text=f"[Сообщение от администратора ✉]\n{message}")
-                except Exception as e:
-                    logger.error(f"Error sending message to {chat_id}: {e}")
+        broadcast_id = await run_io(
+            create_broadcast, f"[Сообщение от администратора ✉]\n{message}", update.message.chat_id, chat_ids,
+            lock=DB_FILE
+        )
+        context.application.create_task(run_broadcast(context.bot, broadcast_id), name=f"broadcast_{broadcast_id}")
 
-        await update.message.reply_text("Сообщение было отправлено всем пользователям.")
+        await update.message.reply_text(
+            f"Рассылка запущена для {len(chat_ids)} пользователей. Отчёт придёт после завершения."
+        )
         return ConversationHandler.END
     except Exception as e:
         logger.error(f"Error in broadcast_message: {e}")
@@ -600,9 +2341,7 @@ async def add_address_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def add_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         address = update.message.text
-        addresses = load_addresses()
-        addresses["addresses"].append(address)
-        save_addresses(addresses)
+        await run_io(append_address, address, lock=ADDRESSES_FILE)
 
         await update.message.reply_text(f"Адрес '{address}' был успешно добавлен.")
         return ConversationHandler.END
@@ -610,73 +2349,110 @@ async def add_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in add_address: {e}")
         await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте снова.")
 
+async def accept_consent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Спасибо за согласие! Переходим к следующему шагу.")
+    await start(update, context)
+
+async def finish_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Спасибо за ваш заказ! Если хотите что-то ещё, выберите из меню.")
+
+async def order_for_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["selected_date"] = update.message.text.replace("Заказать на ", "")
+    await show_menu(update, context)
+
 async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Направляет нажатие кнопки по таблицам BUTTON_ROUTES и PREFIX_ROUTES; кнопки блюд берутся из текущего меню."""
     try:
         text = update.message.text
         logger.info(f"Нажата кнопка: {text}")  # Логируем нажатую кнопку
 
-        if text == "Сделать заказ 🍴":
-            await show_menu(update, context)
-        elif context.user_data.get("awaiting_comment"):
+        if context.user_data.get("awaiting_comment") and text not in COMMENT_BYPASS_BUTTONS:
             await handle_comment(update, context)
             return
-        elif text == "Корзина 🗑":
-            await show_cart(update, context)
-        elif text == "Список заказов":
-            await show_all_orders(update, context)
-        elif text == "Сообщить всем":
-            await broadcast_start(update, context)
-        elif text == "Добавить адрес доставки ":
-            await add_address_start(update, context)
-        elif text == "Комплексный обед":
-            await handle_complex_lunch(update, context, "Комплексный обед")
-        elif text == "Морс":
-            await handle_drink(update, context, "Морс")
-        elif text == "Компот":
-            await handle_drink(update, context, "Компот")
-        elif text == "Цезарь с сёмгой":
-            await handle_salad(update, context, "Цезарь с сёмгой")
-        elif text == "Цезарь с курицей":
-            await handle_salad(update, context, "Цезарь с курицей")
-        elif text == "Оплатить картой💳":
-            await pay(update, context)
-        elif text == "Назад 🔙":
-            await show_menu(update, context)
-        elif text == "Нет, спасибо":
-            await update.message.reply_text("Спасибо за ваш заказ! Если хотите что-то ещё, выберите из меню.")
-        elif text.startswith("Заказать на "):
-            next_day_str = text.replace("Заказать на ", "")
-            context.user_data["selected_date"] = next_day_str
-            await show_menu(update, context)
-        elif text == "Вернуться в главное меню":
-            await show_main_menu(update, context)
-        elif text == "Очистить корзину❌":
-            await clear_cart(update, context)
-        elif text == "Выгрузка заказов":
-            await import_excel(update, context)
-        elif text == "Оплатить наличными":
-            if update.callback_query:
-                pass
-            else:
-                await handle_payment_selection(update, context)
-        elif text == "Я согласен ✔":
-            await update.message.reply_text("Спасибо за согласие! Переходим к следующему шагу.")
-            await start(update, context)
 
-        else:
-            await update.message.reply_text("Неизвестная команда. Пожалуйста, выберите действие из меню.")
+        handler = BUTTON_ROUTES.get(text)
+        if handler is not None:
+            await handler(update, context)
+            return
+
+        if is_dish_button(text):
+            await handle_dish(update, context, text)
+            return
+
+        for prefix, handler in PREFIX_ROUTES:
+            if text.startswith(prefix):
+                await handler(update, context)
+                return
+
+        await update.message.reply_text("Неизвестная команда. Пожалуйста, выберите действие из меню.")
 
     except Exception as e:
         logger.error(f"Ошибка при обработке кнопки: {e}")
         await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте снова.")
 
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Направляет нажатие inline-кнопки по префиксу callback_data; даты меню приходят без префикса."""
+    data = update.callback_query.data or ""
+    handler = CALLBACK_ROUTES.get(data.split("_", 1)[0])
+    if handler is not None:
+        await handler(update, context)
+        return
+    try:
+        datetime.strptime(data, '%d.%m.%Y')
+    except ValueError:
+        logger.warning(f"Unknown callback data: {data}")
+        await update.callback_query.answer()
+        return
+    await handle_menu_and_lunch(update, context)
+
+def _parse_export_args(text):
+    """Разбирает "/export [дд.мм.гггг] [дд.мм.гггг] [csv] [статус=...] [адрес=...]"; адрес — до конца строки."""
+    options = {"date_from": None, "date_to": None, "address": None, "status": None, "fmt": "xlsx"}
+    parts = text.split(maxsplit=1)
+    rest = parts[1] if len(parts) > 1 else ""
+    if "адрес=" in rest:
+        rest, _, options["address"] = rest.partition("адрес=")
+        options["address"] = options["address"].strip()
+    dates = []
+    for token in rest.split():
+        if token.startswith("статус="):
+            options["status"] = token[len("статус="):]
+        elif token.lower() in ("csv", "xlsx"):
+            options["fmt"] = token.lower()
+        else:
+            dates.append(datetime.strptime(token, '%d.%m.%Y').date())
+    if dates:
+        options["date_from"] = dates[0]
+        options["date_to"] = dates[1] if len(dates) > 1 else dates[0]
+    return options
+
 async def import_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     role = context.user_data.get("role")
     if role != "Администратор":
         await update.message.reply_text("У вас нет доступа к этой команде")
         return
-    await update.message.reply_document(ORDERS)
 
+    try:
+        options = _parse_export_args(update.message.text) if update.message.text.startswith("/") else {}
+    except ValueError:
+        await update.message.reply_text(
+            "Формат: /export [с дд.мм.гггг] [по дд.мм.гггг] [csv] [статус=Картой] [адрес=...]"
+        )
+        return
+
+    try:
+        paths = await run_io(export_orders, **options, lock=EXPORT_DIR)
+    except Exception as e:
+        logger.error(f"Error exporting orders: {e}")
+        await update.message.reply_text("Ошибка при выгрузке заказов.")
+        return
+
+    if not paths:
+        await update.message.reply_text("Заказов по заданным условиям нет.")
+        return
+    for number, path in enumerate(paths, start=1):
+        suffix = f"_{number}" if len(paths) > 1 else ""
+        await update.message.reply_document(path, filename=f"Заказы{suffix}{os.path.splitext(path)[1]}")
 
 async def clear_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -684,23 +2460,9 @@ async def clear_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not phone_number:
             await update.message.reply_text("Ваш номер телефона не зарегестрирован")
             return
-        try:
-            with open(ORDERS_JSON, "r", encoding="utf-8") as f:
-                orders = json.load(f)
-        except FileNotFoundError:
-            await update.message.reply_text("Заказов нету")
-            return
-        except json.JSONDecodeError:
-            await update.message.reply_text("Ошибка доступа при обращении к файлу")
-            return
-        
-        initial_count = len(orders)
-        orders = [order for order in orders if order.get("Номер телефона") != phone_number]
+        removed = await run_io(cart_clear, phone_number, lock=DB_FILE)
 
-        with open(ORDERS_JSON, "w", encoding="utf-8") as f:
-            json.dump(orders, f, ensure_ascii=False, indent=4)
-
-        if len(orders) < initial_count:
+        if removed:
             await update.message.reply_text("Корзина успешно очищена")
             await show_main_menu(update, context)
         else:
@@ -718,28 +2480,15 @@ async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not selected_date or not phone_number:
             await update.message.reply_text("Ошибка: не удалось найти данные о заказе.")
             return
-
-        try:
-            orders_df = pd.read_excel(ORDERS)
-        except FileNotFoundError:
-            await update.message.reply_text("Файл с заказами не найден.")
+        if is_date_closed(selected_date):
+            await update.message.reply_text("Заказы на эту дату уже переданы на кухню, отменить их нельзя.")
             return
-        phone_number_clean = ''.join(filter(str.isdigit, phone_number))
-        orders_df['Номер телефона'] = orders_df['Номер телефона'].astype(str).str.replace('[^0-9]', '', regex=True)
 
-        user_orders = orders_df[
-            (orders_df['Номер телефона'] == phone_number_clean) &
-            (orders_df['Дата'] == selected_date)
-        ]
+        removed = await run_io(cancel_history_orders, phone_number, selected_date, lock=DB_FILE)
 
-        if user_orders.empty:
+        if removed == 0:
             await update.message.reply_text("Нет заказов для отмены.")
             return
-        orders_df = orders_df[
-            ~((orders_df['Номер телефона'] == phone_number_clean) &
-              (orders_df['Дата'] == selected_date))
-        ]
-        orders_df.to_excel(ORDERS, index=False)
 
         await update.message.reply_text("Ваши заказы успешно отменены!")
         await show_main_menu(update, context)
@@ -776,230 +2525,43 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка при обработке текстового сообщения: {e}")
         await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте снова.")
 
-async def handle_drink(update: Update, context: ContextTypes.DEFAULT_TYPE, drink_name: str):
-    user_data = load_user_data()
-    pay = context.user_data.get("payment_id")
-    try:
-            phone = context.user_data.get("phone_number")
-            user = next((u for u in user_data["users"] if u["phone"] == phone), None)
-            if phone is None:
-                await update.message.reply_text("Ваш номер телефона не зарегистрирован, перезапустите бота!")
-                return
-            selected_date = context.user_data.get("selected_date")
-            if selected_date is None:
-                await update.message.reply_text("Выберите дату, прежде чем заказывать обед.")
-                return
-            selected_day_name = context.user_data.get("selected_day_name")
-            address = user['address']
-            if address is None:
-                await update.message.reply_text("Вы не выбрали адрес, перезапустите бота!")
-                return
-
-            try:
-                menu_data = pd.read_csv(MENU)
-                drink_price = dict(zip(menu_data['Блюдо'], menu_data['Цена']))
-
-                price = drink_price.get(drink_name)
-                if price is None:
-                    await update.message.reply_text(f"Цена для {drink_name} не найдена в меню.")
-                    return
-                try:
-                    with open(ORDERS_JSON, 'r', encoding='utf-8') as f:
-                        try:
-                            orders = json.load(f)
-
-                            if not isinstance(orders, list):
-                                orders = []
-                        except json.JSONDecodeError:
-
-                            orders = []
-                except FileNotFoundError:
-
-                    orders = []
-
-                new_order = {
-                "Номер телефона": phone,
-                "Дата": selected_date,
-                "День недели": selected_day_name,
-                "Обед": drink_name,
-                "Цена": int(price),
-                "Статус оплаты": "Не оплачено",
-                "Адрес доставки": address,
-                "Имя заказчика": user["name"],
-                }
-                try:
-                    with open(ORDERS_JSON, 'r', encoding='utf-8') as f:
-                        try:
-                            orders = json.load(f)
-                            if not isinstance(orders, list):
-                                orders = []
-                        except json.JSONDecodeError:
-                            orders = []
-                except FileNotFoundError:
-                    orders = []
-
-                orders.append(new_order)
-
-                with open(ORDERS_JSON, 'w', encoding='utf-8') as f:
-                    json.dump(orders, f, ensure_ascii=False, indent=4)
-                logger.info(f"Заказ сохранён: {drink_name}, цена: {price}, дата: {selected_date}, телефон: {phone}")
-                await update.message.reply_text(f"Ваш выбор ({drink_name}) записан! Цена: {price} рублей.")
-            except Exception as e:
-                logger.error(f"Ошибка записи в файл: {e}")
-                await update.message.reply_text(f"Ошибка записи в файл: {e}")
-   
-    except Exception as e:
-        logger.error(f"Ошибка при обработке комплексного обеда: {e}")
-        await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте снова.")
-
-async def handle_salad(update: Update, context: ContextTypes.DEFAULT_TYPE, salad_name: str):
-    user_data = load_user_data()
-    try:
-            phone = context.user_data.get("phone_number")
-            user = next((u for u in user_data["users"] if u["phone"] == phone), None)
-            if phone is None:
-                await update.message.reply_text("Ваш номер телефона не зарегистрирован, перезапустите бота!")
-                return
-            selected_date = context.user_data.get("selected_date")
-            if selected_date is None:
-                await update.message.reply_text("Выберите дату, прежде чем заказывать обед.")
-                return
-            selected_day_name = context.user_data.get("selected_day_name")
-            address = user['address']
-            if address is None:
-                await update.message.reply_text("Вы не выбрали адрес, перезапустите бота!")
-                return
-            try:
-                menu_data = pd.read_csv(MENU)
-                salad_price = dict(zip(menu_data['Блюдо'], menu_data['Цена']))
-
-                price = salad_price.get(salad_name)
-                if price is None:
-                    await update.message.reply_text(f"Цена для {salad_name} не найдена в меню.")
-                    return
-                try:
-                    with open(ORDERS_JSON, 'r', encoding='utf-8') as f:
-                        try:
-                            orders = json.load(f)
-
-                            if not isinstance(orders, list):
-                                orders = []
-                        except json.JSONDecodeError:
-
-                            orders = []
-                except FileNotFoundError:
-
-                    orders = []
-
-                new_order = {
-                "Номер телефона": phone,
-                "Дата": selected_date,
-                "День недели": selected_day_name,
-                "Обед": salad_name,
-                "Цена": int(price),
-                "Статус оплаты": "Не оплачено",
-                "Адрес доставки": address,
-                "Имя заказчика": user["name"],
-                }
-                try:
-                    with open(ORDERS_JSON, 'r', encoding='utf-8') as f:
-                        try:
-                            orders = json.load(f)
-                            if not isinstance(orders, list):
-                                orders = []
-                        except json.JSONDecodeError:
-                            orders = []
-                except FileNotFoundError:
-                    orders = []
-
-                orders.append(new_order)
-
-                with open(ORDERS_JSON, 'w', encoding='utf-8') as f:
-                    json.dump(orders, f, ensure_ascii=False, indent=4)
-                logger.info(f"Заказ сохранён: {salad_name}, цена: {price}, дата: {selected_date}, телефон: {phone}")
-                await update.message.reply_text(f"Ваш выбор ({salad_name}) записан! Цена: {price} рублей.")
-            except Exception as e:
-                logger.error(f"Ошибка записи в файл: {e}")
-                await update.message.reply_text(f"Ошибка записи в файл: {e}")
-
-    except Exception as e:
-        logger.error(f"Ошибка при обработке комплексного обеда: {e}")
-        await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте снова.")
-
-async def handle_complex_lunch(update: Update, context: ContextTypes.DEFAULT_TYPE, lunch_name: str):
-    user_data = load_user_data()
+async def handle_dish(update: Update, context: ContextTypes.DEFAULT_TYPE, dish_name: str):
     try:
         phone = context.user_data.get("phone_number")
-        user = next((u for u in user_data["users"] if u["phone"] == phone), None)
+        user = get_user_profile(phone=phone)
         if phone is None:
             await update.message.reply_text("Ваш номер телефона не зарегистрирован, перезапустите бота!")
             return
-
         selected_date = context.user_data.get("selected_date")
         if selected_date is None:
             await update.message.reply_text("Выберите дату, прежде чем заказывать обед.")
             return
+        if is_date_closed(selected_date):
+            await update.message.reply_text(f"Приём заказов на {selected_date} уже закрыт.")
+            return
         selected_day_name = context.user_data.get("selected_day_name")
-        address = user['address']
+        address = user.get('address') if user else None
         if address is None:
             await update.message.reply_text("Вы не выбрали адрес, перезапустите бота!")
             return
-        try:
-            menu_data = pd.read_csv(MENU)
-            lunch_prices = dict(zip(menu_data['Название'], menu_data['Цена']))
 
-            price = lunch_prices.get(lunch_name)
+        try:
+            daily_menu = get_daily_menu(selected_date)
+            price = daily_menu["prices"].get(dish_name) if daily_menu else None
             if price is None:
-                await update.message.reply_text(f"Цена для {lunch_name} не найдена в меню.")
+                await update.message.reply_text(f"Цена для {dish_name} не найдена в меню.")
                 return
-            try:
-                with open(ORDERS_JSON, 'r', encoding='utf-8') as f:
-                    try:
-                        orders = json.load(f)
-
-                        if not isinstance(orders, list):
-                            orders = []
-                    except json.JSONDecodeError:
 
-                        orders = []
-            except FileNotFoundError:
-
-                orders = []
-
-
-            new_order = {
-            "Номер телефона": phone,
-            "Дата": selected_date,
-            "День недели": selected_day_name,
-            "Обед": lunch_name,
-            "Цена": int(price),
-            "Статус оплаты": "не оплачено",
-            "Адрес доставки": address,
-            "Имя заказчика": user["name"]
-            }
-            try:
-                with open(ORDERS_JSON, 'r', encoding='utf-8') as f:
-                    try:
-                        orders = json.load(f)
-                        if not isinstance(orders, list):
-                            orders = []
-                    except json.JSONDecodeError:
-                        orders = []
-            except FileNotFoundError:
-                orders = []
-
-            orders.append(new_order)
-
-            with open(ORDERS_JSON, 'w', encoding='utf-8') as f:
-                json.dump(orders, f, ensure_ascii=False, indent=4)
-            logger.info(f"Заказ сохранён: {lunch_name}, цена: {price}, дата: {selected_date}, телефон: {phone}")
-            await update.message.reply_text(f"Ваш выбор ({lunch_name}) записан! Цена: {price} рублей.")
+            new_order = new_cart_record(phone, selected_date, selected_day_name, dish_name, price, user)
+            await run_io(cart_add, new_order, lock=DB_FILE)
+            logger.info(f"Заказ сохранён: {dish_name}, цена: {price}, дата: {selected_date}, телефон: {phone}")
+            await update.message.reply_text(f"Ваш выбор ({dish_name}) записан! Цена: {price} рублей.")
         except Exception as e:
             logger.error(f"Ошибка записи в файл: {e}")
             await update.message.reply_text(f"Ошибка записи в файл: {e}")
-    
+
     except Exception as e:
-        logger.error(f"Ошибка при обработке комплексного обеда: {e}")
+        logger.error(f"Ошибка при обработке блюда: {e}")
         await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте снова.")
 
 
@@ -1023,15 +2585,323 @@ async def handle_payment_selection(update: Update, context: ContextTypes.DEFAULT
         else:
             await update.message.reply_text("Ошибка при переносе заказа в историю.")
 
+def record_payment(payment_id, phone, chat_id, amount):
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO payments (payment_id, phone, chat_id, amount, status, created_at) "
+            "VALUES (?, ?, ?, ?, 'pending', ?)",
+            (payment_id, phone, chat_id, amount, datetime.now().isoformat())
+        )
+
+def finish_payment(payment_id, status):
+    conn = get_db()
+    with conn:
+        cursor = conn.execute(
+            "UPDATE payments SET status = ?, finished_at = ? WHERE payment_id = ? AND status = 'pending'",
+            (status, datetime.now().isoformat(), payment_id)
+        )
+    return cursor.rowcount > 0
+
+def pending_payments():
+    return get_db().execute("SELECT * FROM payments WHERE status = 'pending'").fetchall()
+
+def payment_chat_id(payment_id):
+    row = get_db().execute("SELECT chat_id FROM payments WHERE payment_id = ?", (payment_id,)).fetchone()
+    return row["chat_id"] if row else None
+
+class PaymentWatcher:
+    """Один фоновый цикл проверяет все ожидающие платежи: очередь по времени следующей проверки,
+    интервал растёт от PAYMENT_POLL_MIN до PAYMENT_POLL_MAX, запросы к YooKassa идут в пуле с ограничением."""
+
+    def __init__(self, api):
+        self.api = api
+        self.queue = []
+        self.pending = {}
+        self.bot = None
+        self.task = None
+        self.wakeup = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(PAYMENT_CONCURRENCY)
+        self.checks = set()
+        self.min_interval = PAYMENT_POLL_MIN
+        self.max_interval = PAYMENT_POLL_MAX
+
+    async def start(self, bot):
+        self.bot = bot
+        for row in await run_io(pending_payments):
+            if not owns_chat(row["chat_id"]):
+                continue
+            created_at = datetime.fromisoformat(row["created_at"])
+            self.watch(row["payment_id"], row["phone"], row["chat_id"], created_at)
+        self.task = asyncio.create_task(self.run(), name="payment_watcher")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        for check in list(self.checks):
+            check.cancel()
+
+    def watch(self, payment_id, phone, chat_id, created_at=None):
+        self.pending[payment_id] = {
+            "phone": phone,
+            "chat_id": chat_id,
+            "created_at": created_at or datetime.now(),
+            "interval": self.min_interval,
+        }
+        heapq.heappush(self.queue, (monotonic() + self.min_interval, payment_id))
+        self.wakeup.set()
+
+    def _reschedule(self, payment_id):
+        info = self.pending.get(payment_id)
+        if info is None:
+            return
+        info["interval"] = min(info["interval"] * PAYMENT_POLL_BACKOFF, max(self.max_interval, self.min_interval))
+        heapq.heappush(self.queue, (monotonic() + info["interval"], payment_id))
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                _, payment_id = heapq.heappop(self.queue)
+                if payment_id in self.pending:
+                    check = asyncio.create_task(self._check(payment_id))
+                    self.checks.add(check)
+                    check.add_done_callback(self.checks.discard)
+            timeout = self.queue[0][0] - now if self.queue else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, payment_id):
+        info = self.pending.get(payment_id)
+        if info is None:
+            return
+        try:
+            async with self.semaphore:
+                payment = await run_io(external_call, "yookassa", "find_one", self.api.find_one, payment_id)
+            status = payment.status
+        except Exception as e:
+            # Статус неизвестен — платёж мог пройти, поэтому по таймауту его не отменяем, а проверяем снова
+            logger.error(f'Ошибка при проверке статуса платежа {payment_id}: {str(e)}')
+            self._reschedule(payment_id)
+            return
+
+        try:
+            if status in ("succeeded", "canceled"):
+                await self.complete(payment_id, status)
+            elif (datetime.now() - info["created_at"]).total_seconds() >= PAYMENT_TIMEOUT:
+                await self.complete(payment_id, "expired")
+            else:
+                self._reschedule(payment_id)
+        except Exception:
+            pass  # complete уже записал ошибку в лог и поставил повторную проверку
+
+    async def complete(self, payment_id, status):
+        """Завершает платёж один раз, кто бы ни узнал о результате первым.
+        Платёж остаётся в pending, пока статус не записан в базу: при ошибке записи проверка повторится."""
+        info = self.pending.get(payment_id)
+        if info is None:
+            return False
+        try:
+            finished = await run_io(finish_payment, payment_id, status, lock=DB_FILE)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении статуса платежа {payment_id}: {e}")
+            self._reschedule(payment_id)
+            raise
+        self.pending.pop(payment_id, None)
+        if not finished:
+            return False
+
+        chat_id = info["chat_id"]
+        try:
+            if status == "succeeded":
+                success, order_id = await move_orders_to_excel(info["phone"], "Картой")
+                if success:
+                    await self.bot.send_message(chat_id, "Оплата прошла успешно! Ваш заказ перенесён в историю.")
+                    await self.bot.send_message(
+                        chat_id, "Главное меню:",
+                        reply_markup=ReplyKeyboardMarkup(get_role_keyboard("Заказчик"), resize_keyboard=True)
+                    )
+                else:
+                    await self.bot.send_message(chat_id, "Ошибка при переносе заказа в историю.")
+            elif status == "canceled":
+                await self.bot.send_message(chat_id, f'Платеж {payment_id} отменен.')
+            else:
+                await run_io(cart_clear, info["phone"], lock=DB_FILE)
+                await self.bot.send_message(chat_id, "Время ожидания оплаты истекло. Платеж отменен.")
+        except Exception as e:
+            logger.error(f"Ошибка при завершении платежа {payment_id}: {e}")
+        return True
+
+payment_watcher = PaymentWatcher(payment_api)
+register_gauge("bot_pending_payments", "Payments waiting for a final status", lambda: len(payment_watcher.pending))
+
+# Встроенный HTTP-сервер для уведомлений и служебных страниц; маршруты регистрируются через http_route
+_http_routes = {}
+_http_server = None
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large",
+                500: "Internal Server Error", 503: "Service Unavailable"}
+
+def http_route(method, path):
+    def decorator(handler):
+        _http_routes[(method, path)] = handler
+        return handler
+    return decorator
+
+class HttpBodyTooLarge(Exception):
+    pass
+
+async def _read_http_request(reader, peer):
+    """Читает один запрос. Некорректная строка запроса или заголовки — ValueError (400),
+    тело больше HTTP_MAX_BODY — HttpBodyTooLarge (413)."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length < 0:
+        raise ValueError("negative content-length")
+    if length > HTTP_MAX_BODY:
+        raise HttpBodyTooLarge()
+    body = await reader.readexactly(length) if length else b""
+    remote = peer[0] if peer else None
+    if HTTP_TRUST_PROXY and "x-forwarded-for" in headers:
+        # Левые адреса присылает клиент, доверять можно только добавленному нашим прокси
+        remote = headers["x-forwarded-for"].split(",")[-1].strip()
+    path, _, query = target.partition("?")
+    return SimpleNamespace(method=method, path=path, query=query, headers=headers, body=body, remote=remote)
+
+async def _handle_http_connection(reader, writer):
+    peer = writer.get_extra_info("peername")
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(_read_http_request(reader, peer), HTTP_READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+            except HttpBodyTooLarge:
+                request, status, content_type, body = None, 413, "text/plain", b"payload too large"
+            except ValueError:
+                request, status, content_type, body = None, 400, "text/plain", b"bad request"
+            else:
+                if request is None:
+                    break
+                handler = _http_routes.get((request.method, request.path))
+                if handler is None:
+                    status, content_type, body = 404, "text/plain", b"not found"
+                else:
+                    try:
+                        status, content_type, body = await handler(request)
+                    except Exception as e:
+                        logger.error(f"Error handling {request.method} {request.path}: {e}")
+                        status, content_type, body = 500, "text/plain", b"error"
+            keep_alive = request is not None and request.headers.get("connection", "").lower() != "close"
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def start_http_server(port=HTTP_PORT):
+    global _http_server
+    if not port:
+        return None
+    _http_server = await asyncio.start_server(_handle_http_connection, HTTP_HOST, port)
+    logger.info(f"HTTP server listening on {HTTP_HOST}:{port}")
+    return _http_server
+
+async def stop_http_server():
+    if _http_server is not None:
+        _http_server.close()
+        await _http_server.wait_closed()
+
+def _is_yookassa_address(remote):
+    try:
+        address = ipaddress.ip_address(remote)
+    except (TypeError, ValueError):
+        return False
+    return any(address in network for network in YOOKASSA_NETWORKS)
+
+@http_route("POST", YOOKASSA_WEBHOOK_PATH)
+async def yookassa_webhook(request):
+    """Уведомление YooKassa о платеже. Статус из тела не принимается на веру, а перепроверяется запросом к API."""
+    if YOOKASSA_CHECK_IP and not _is_yookassa_address(request.remote):
+        logger.warning(f"Rejected YooKassa notification from {request.remote}")
+        return 403, "text/plain", b"forbidden"
+    try:
+        notification = json.loads(request.body)
+        event = notification["event"]
+        payment_id = notification["object"]["id"]
+    except (ValueError, KeyError, TypeError):
+        return 400, "text/plain", b"bad notification"
+
+    if event not in ("payment.succeeded", "payment.canceled"):
+        return 200, "text/plain", b"ignored"
+
+    if worker_pool is not None:
+        # Платёж завершает процесс, который его создал и следит за ним
+        chat_id = await run_io(payment_chat_id, payment_id)
+        if chat_id is None:
+            return 200, "text/plain", b"ignored"
+        await worker_pool.forward(chat_id, ("payment", payment_id))
+        return 200, "text/plain", b"ok"
+
+    if not await check_payment_notification(payment_id):
+        return 200, "text/plain", b"ignored"
+    return 200, "text/plain", b"ok"
+
+async def check_payment_notification(payment_id):
+    payment = await run_io(external_call, "yookassa", "find_one", payment_api.find_one, payment_id)
+    if payment.status not in ("succeeded", "canceled"):
+        logger.warning(f"Notification for payment {payment_id} in status {payment.status}")
+        return False
+    await payment_watcher.complete(payment_id, payment.status)
+    return True
+
+@http_route("GET", "/metrics")
+async def metrics_endpoint(request):
+    try:
+        local = ipaddress.ip_address(request.remote).is_loopback
+    except (TypeError, ValueError):
+        local = False
+    if not local and not METRICS_PUBLIC:
+        return 403, "text/plain", b"forbidden"
+    return 200, "text/plain; version=0.0.4; charset=utf-8", render_metrics().encode("utf-8")
+
 async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Создаёт платёж с суммой из корзины."""
+    """Создаёт платёж с суммой из заголовка корзины."""
     try:
-        total_price = context.user_data.get("total_price", 0)
+        summary = await run_io(cart_summary, context.user_data.get("phone_number"))
+        total_price = summary["total"] if summary else 0
+        context.user_data["total_price"] = total_price
         if total_price == 0:
             await update.message.reply_text("Ваша корзина пуста, оплатить нечего.")
             return
 
-        payment = Payment.create({
+        payment = await run_io(external_call, "yookassa", "create", payment_api.create, {
             "amount": {"value": f"{total_price}.00", "currency": "RUB"},
             "confirmation": {"type": "redirect", "return_url": "https://t.me/DirTasteBot"},
             "capture": True,
@@ -1039,77 +2909,19 @@ async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         })
 
         context.user_data['payment_id'] = payment.id
+        phone = context.user_data.get("phone_number")
+        await run_io(record_payment, payment.id, phone, update.message.chat_id, total_price, lock=DB_FILE)
+        payment_watcher.watch(payment.id, phone, update.message.chat_id)
 
         await update.message.reply_text(
             f'Платёж создан! Перейдите по ссылке({payment.confirmation.confirmation_url}) для оплаты.',
             parse_mode='Markdown'
         )
 
-        asyncio.create_task(check_payment_status(update, context, payment.id))
-
     except Exception as e:
         logger.error(f'Ошибка при создании платежа: {str(e)}')
         await update.message.reply_text(f'Ошибка при создании платежа: {str(e)}')
 
-async def check_payment_status(update: Update, context: ContextTypes.DEFAULT_TYPE, payment_id: str) -> None:
-    try:
-        start_time = datetime.now()
-        while True:
-            await asyncio.sleep(10)
-            try:
-                payment = Payment.find_one(payment_id)
-                status = payment.status
-
-                if status == 'succeeded':
-                    phone = context.user_data.get("phone_number")
-                    if phone:
-                        success, order_id = await move_orders_to_excel(phone, "Картой")
-                        if success:
-                            await update.message.reply_text("Оплата прошла успешно! Ваш заказ перенесён в историю.")
-                            await show_main_menu(update, context)
-                            return
-                        else:
-                            await update.message.reply_text("Ошибка при переносе заказа в историю.")
-                            return
-                    return
-
-                if status == 'pending':
-                    # Проверяем, прошло ли 10 минут
-                    if (datetime.now() - start_time).total_seconds() >= 600:
-                        await cancel_payment(update, context, payment_id)
-                        await update.message.reply_text("Время ожидания оплаты истекло. Платеж отменен.")
-                        return
-
-                if status == 'canceled':
-                    await update.message.reply_text(f'Платеж {payment_id} отменен.')
-                    return
-
-                context.user_data['payment.status'] = status
-
-            except Exception as e:
-                logger.error(f'Ошибка при проверке статуса платежа: {str(e)}')
-                await update.message.reply_text(f'Ошибка при проверке статуса платежа: {str(e)}')
-                return
-
-    except Exception as e:
-        logger.error(f'Критическая ошибка в check_payment_status: {str(e)}')
-        await update.message.reply_text('Произошла критическая ошибка. Пожалуйста, попробуйте позже.')
-
-async def cancel_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, payment_id: str) -> None:
-    try:
-        payment = Payment.find_one(payment_id)
-        current_status = payment.status
-
-        if current_status != 'succeeded':
-            try:
-                await clear_cart(update, context)
-            except Exception as e:
-                logger.error(f"Ошибка при очистке корзины: {e}")
-                await update.message.reply_text("Ошибка при очистке корзины. Пожалуйста, попробуйте позже.")
-
-    except Exception as e:
-        logger.error(f"Ошибка при отмене платежа: {e}")
-
 async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     phone = context.user_data.get("phone_number")
@@ -1119,36 +2931,26 @@ async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     try:
-        with open(ORDERS_JSON, "r", encoding="utf-8") as f:
-            orders = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
+        summary = await run_io(cart_summary, phone)
+    except Exception as e:
+        logger.error(f"Error loading cart: {e}")
         await update.message.reply_text("Ошибка при загрузке заказов.")
         return ConversationHandler.END
 
-    user_orders = [order for order in orders if order.get("Номер телефона") == phone]
-
-    if not user_orders:
+    if not summary:
         await update.message.reply_text("Ваша корзина пуста.")
         return ConversationHandler.END
 
-    from collections import defaultdict
-    grouped_orders = defaultdict(lambda: {"Блюда": [], "Цена": 0, "День недели": ""})
-
-    for order in user_orders:
-        date = order["Дата"]
-        grouped_orders[date]["Блюда"].append(order["Обед"])
-        grouped_orders[date]["Цена"] += order["Цена"]
-        grouped_orders[date]["День недели"] = order["День недели"]
-
-    total_price = sum(details["Цена"] for details in grouped_orders.values())
+    # Подытоги по дням и общая сумма уже посчитаны в заголовке корзины
+    total_price = summary["total"]
     context.user_data["total_price"] = total_price  # Сохраняем сумму
 
     cart_message = "🛒 *Ваша корзина:*\n\n"
-    for date, details in grouped_orders.items():
+    for day in summary["days"]:
         cart_message += (
-            f"📅 *Дата*: {date} ({details['День недели']})\n"
-            f"🍽 *Состав заказа*: {', '.join(details['Блюда'])}\n"
-            f"💰 *Цена*: {details['Цена']} рублей\n\n"
+            f"📅 *Дата*: {day['date']} ({day['day_name'] or ''})\n"
+            f"🍽 *Состав заказа*: {day['dishes']}\n"
+            f"💰 *Цена*: {day['subtotal']} рублей\n\n"
         )
     cart_message += f"💵 *Общая сумма*: {total_price} рублей"
 
@@ -1184,19 +2986,7 @@ async def handle_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         phone = context.user_data.get("phone_number")
         if phone:
             try:
-                with open(ORDERS_JSON, "r", encoding="utf-8") as f:
-                    orders = json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError) as e:
-                logger.error(f"Error loading orders: {e}")
-                orders = []
-
-            for order in orders:
-                if order.get("Номер телефона") == phone:
-                    order["Комментарий"] = comment
-
-            try:
-                with open(ORDERS_JSON, "w", encoding="utf-8") as f:
-                    json.dump(orders, f, ensure_ascii=False, indent=4)
+                await run_io(cart_set_comment, phone, comment, lock=DB_FILE)
             except Exception as e:
                 logger.error(f"Error saving orders with comment: {e}")
 
@@ -1224,123 +3014,674 @@ async def show_payment_options(update: Update, context: ContextTypes.DEFAULT_TYP
         return ConversationHandler.END
 
 
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Отмена ввода комментария.")
-    return ConversationHandler.END
-
 async def show_all_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("role") != "Администратор":
         await update.message.reply_text("У вас нет прав для использования этой функции.")
         return
 
-    try:
-        orders_df = pd.read_excel(ORDERS)
-    except FileNotFoundError:
-        await update.message.reply_text("Файл с заказами не найден.")
-        return
-
-    if orders_df.empty:
-        await update.message.reply_text("Заказов пока нет.")
-        return
-
     today = datetime.today().date()
-    todaystr = today.strftime("%d.%m.%Y")
-    today_orders = orders_df[orders_df['Дата'] == todaystr]
-    if today_orders.empty:
-        await update.message.reply_text("Заказов на сегодня нет.")
+    if context.args:
+        try:
+            selected_date = datetime.strptime(context.args[0], '%d.%m.%Y').date()
+        except ValueError:
+            await update.message.reply_text("Укажите дату в формате дд.мм.гггг, например /orders 01.03.2025")
+            return
+    else:
+        selected_date = today
+    date_label = "сегодня" if selected_date == today else selected_date.strftime("%d.%m.%Y")
+
+    # Для закрытого дня берётся отчёт, посчитанный при отсечке (и дополненный оплатами, прошедшими после неё)
+    totals = await run_io(load_kitchen_report, selected_date.toordinal())
+    if totals is None:
+        totals = await run_io(load_kitchen_totals, selected_date.toordinal())
+    if not totals:
+        await update.message.reply_text(f"Заказов на {date_label} нет.")
         return
+    for text in format_kitchen_report(totals, date_label):
+        await update.message.reply_text(text)
+
+def format_kitchen_report(totals, date_label):
+    """Два сообщения для кухни: заказы по адресам и общий итог по блюдам. totals — тройки (адрес, блюдо, количество)."""
     dish_count = {}
     dish_count_end = {}
-    for index, row in today_orders.iterrows():
-        address = row['Адрес доставки']
-        dish = row['Обед']
-        if address not in dish_count:
-            dish_count[address] = {}
-        if dish not in dish_count[address]:
-            dish_count[address][dish] = 1
-        else:
-            dish_count[address][dish] += 1
-        if dish not in dish_count_end:
-            dish_count_end[dish] = 1
-        else:
-            dish_count_end[dish] += 1
-    orders_text = "Список заказов на сегодня:\n\n"
+    for address, dish, count in totals:
+        dish_count.setdefault(address, {})[dish] = count
+        dish_count_end[dish] = dish_count_end.get(dish, 0) + count
+
+    orders_text = f"Список заказов на {date_label}:\n\n"
     for address, dishes in dish_count.items():
         orders_text += f"Адрес доставки: {address}\n"
         for dish, count in dishes.items():
             orders_text += f"  - {dish}: {count}\n"
         orders_text += "\n"
 
-    await update.message.reply_text(orders_text)
-
-    orders_text = "Итого:\n"
+    totals_text = "Итого:\n"
     for dish, count in dish_count_end.items():
-        orders_text += f"  - {dish}: {count}\n"
+        totals_text += f"  - {dish}: {count}\n"
+    return [orders_text, totals_text]
 
-    await update.message.reply_text(orders_text)
-
-def main():
+async def cutoff_job(context: ContextTypes.DEFAULT_TYPE):
+    """Отсечка: закрывает последний день, приём заказов на который уже закончился (после CUTOFF_TIME это
+    closing_date()), и отправляет администраторам готовый отчёт для кухни."""
+    day = last_closed_date()
     try:
-        # Configure application with proper timeouts and update parameters
-        application = (
-            Application.builder()
-            .token(TOKEN)
-            .connect_timeout(30)
-            .read_timeout(30)
-            .write_timeout(30)
-            .pool_timeout(30)
-            .build()
-        )
+        report = await run_io(close_day, day.toordinal(), lock=DB_FILE)
+    except Exception as e:
+        logger.error(f"Error closing day {day}: {e}")
+        return
+    if report is None:
+        return
+    logger.info(
+        f"Closed {day}: {len(report['totals'])} report rows, "
+        f"{report['expired']} cart entries expired, {report['converted']} converted"
+    )
 
-        registration_handler = ConversationHandler(
-            entry_points=[MessageHandler(filters.CONTACT, start)],
-            states={
-                CHOOSE_ADDRESS: [CallbackQueryHandler(choose_address)],
-                ENTER_NAME: [MessageHandler(filters.TEXT, enter_name)],
-            },
-            fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
+    if report["totals"]:
+        messages = format_kitchen_report(report["totals"], day.strftime("%d.%m.%Y"))
+    else:
+        messages = [f"Заказов на {day.strftime('%d.%m.%Y')} нет."]
+    admins = [user["chat_id"] for user in all_users() if user.get("role") == "Администратор" and user.get("chat_id")]
+    for chat_id in admins:
+        try:
+            for text in messages:
+                await context.bot.send_message(chat_id, text)
+        except Exception as e:
+            logger.error(f"Error sending kitchen report to {chat_id}: {e}")
+
+def load_sessions(since):
+    rows = get_db().execute("SELECT user_id, data FROM sessions WHERE updated_at >= ?", (since,)).fetchall()
+    return {row["user_id"]: json.loads(row["data"]) for row in rows}
+
+def load_session(user_id):
+    row = get_db().execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+    return json.loads(row["data"]) if row else None
+
+def load_conversations(name):
+    rows = get_db().execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+    return {tuple(json.loads(row["key"])): json.loads(row["state"]) for row in rows}
+
+@instrumented("bot_storage", op="save_sessions")
+def save_sessions(sessions, dropped, conversations):
+    """sessions — user_id -> user_data, уже сериализованные в JSON."""
+    now = datetime.now().timestamp()
+    conn = get_db()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)",
+            [(user_id, data, now) for user_id, data in sessions.items()]
         )
+        conn.executemany("DELETE FROM sessions WHERE user_id = ?", [(user_id,) for user_id in dropped])
+        for (name, key), state in conversations.items():
+            if state is None:
+                conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                    (name, key, json.dumps(state))
+                )
 
-        broadcast_handler = ConversationHandler(
-            entry_points=[MessageHandler(filters.Regex("^Сообщить всем$"), broadcast_start)],
-            states={
-                BROADCAST_MESSAGE: [MessageHandler(filters.TEXT, broadcast_message)],
-            },
-            fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
-        )
+class SQLitePersistence(BasePersistence):
+    """Хранит context.user_data и состояния диалогов в Bot.db.
 
-        address_handler = ConversationHandler(
-            entry_points=[MessageHandler(filters.Regex("^Добавить адрес доставки$"), add_address_start)],
-            states={
-                ADD_ADDRESS: [MessageHandler(filters.TEXT, add_address)],
-            },
-            fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
-        )
-        comment_handler = ConversationHandler(
-            entry_points=[MessageHandler(filters.Regex("^Корзина 🗑$"), show_cart)],
-            states={
-                ENTER_COMMENT: [MessageHandler(filters.TEXT, handle_comment)]
-            },
-            fallbacks=[CommandHandler("cancel", cancel)],
+    Application раз в SESSION_FLUSH_INTERVAL отдаёт изменённые сессии; они копятся в памяти и пишутся
+    одной транзакцией. При старте загружаются только недавно активные сессии, остальные подгружаются
+    при первом обращении пользователя."""
+
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=SESSION_FLUSH_INTERVAL
         )
+        self.dirty_sessions = {}
+        self.dropped_sessions = set()
+        self.dirty_conversations = {}
+        self.known_users = set()
+        self.flush_task = None
+
+    async def get_user_data(self):
+        since = (datetime.now() - timedelta(days=SESSION_WARM_DAYS)).timestamp()
+        sessions = {user_id: data for user_id, data in (await run_io(load_sessions, since)).items() if owns_chat(user_id)}
+        self.known_users.update(sessions)
+        logger.info(f"Loaded {len(sessions)} active sessions")
+        return sessions
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self.known_users:
+            return
+        self.known_users.add(user_id)
+        if not user_data:
+            stored = await run_io(load_session, user_id)
+            if stored:
+                user_data.update(stored)
+
+    async def update_user_data(self, user_id, data):
+        self.known_users.add(user_id)
+        self.dropped_sessions.discard(user_id)
+        # Сериализуем сразу, в цикле событий: сам словарь обработчики продолжают менять, пока идёт запись в потоке
+        self.dirty_sessions[user_id] = json.dumps(data, ensure_ascii=False, default=str)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self.dirty_sessions.pop(user_id, None)
+        self.dropped_sessions.add(user_id)
+        self._schedule_flush()
+
+    async def get_conversations(self, name):
+        conversations = await run_io(load_conversations, name)
+        return {key: state for key, state in conversations.items() if owns_chat(key[0])}
+
+    async def update_conversation(self, name, key, new_state):
+        self.dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(SESSION_FLUSH_DELAY)
+        await self._write()
+
+    async def _write(self):
+        sessions, self.dirty_sessions = self.dirty_sessions, {}
+        dropped, self.dropped_sessions = self.dropped_sessions, set()
+        conversations, self.dirty_conversations = self.dirty_conversations, {}
+        if sessions or dropped or conversations:
+            try:
+                await run_io(save_sessions, sessions, dropped, conversations, lock=DB_FILE)
+            except Exception as e:
+                logger.error(f"Error saving sessions: {e}")
+
+    async def flush(self):
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+        await self._write()
+
+    # chat_data, bot_data и callback_data боту не нужны и не сохраняются (см. store_data)
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает до workers обновлений одновременно, но обновления одного чата — строго по порядку.
+
+    Сначала берётся блокировка чата и только потом место в пуле, поэтому ждущие обновления одного чата
+    не занимают пул и не задерживают остальных. Если у чата уже CHAT_BACKLOG_LIMIT обновлений в очереди,
+    новые отбрасываются — так один пользователь, часто нажимающий кнопки, не вытесняет других."""
+
+    def __init__(self, workers, backlog_limit=CHAT_BACKLOG_LIMIT):
+        # Семафор базового класса ограничивает число принятых обновлений, свой — число выполняющихся
+        super().__init__(max_concurrent_updates=UPDATES_IN_FLIGHT)
+        self.workers = asyncio.Semaphore(workers)
+        self.backlog_limit = backlog_limit
+        self.chats = {}  # chat_id -> [asyncio.Lock, обновлений в работе и в очереди]
+
+    @staticmethod
+    def _chat_key(update):
+        if isinstance(update, Update):
+            chat = update.effective_chat or update.effective_user
+            if chat is not None:
+                return chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            async with self.workers:
+                await coroutine
+            return
+
+        entry = self.chats.get(key)
+        if entry is None:
+            entry = self.chats[key] = [asyncio.Lock(), 0]
+        if entry[1] >= self.backlog_limit:
+            coroutine.close()
+            inc("bot_updates_dropped_total")
+            logger.warning(f"Dropped update {update.update_id} from chat {key}: {entry[1]} updates already queued")
+            return
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.workers:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.chats[key]
+
+    @property
+    def backlog(self):
+        return sum(entry[1] for entry in self.chats.values())
 
-        # Add handlers
-        application.add_handler(CommandHandler("start", under_start))
-        application.add_handler(registration_handler)
-        application.add_handler(broadcast_handler)
-        application.add_handler(address_handler)
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
-        application.add_handler(CallbackQueryHandler(handle_menu_and_lunch))
-        application.add_handler(CallbackQueryHandler(button_callback))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
-        application.add_handler(MessageHandler(filters.Regex("^Корзина 🗑$"), show_cart))
-        application.add_handler(comment_handler)
-
-        # Start the bot with proper polling configuration
-        application.run_polling(
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+async def io_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get("role") != "Администратор":
+        await update.message.reply_text("У вас нет прав для использования этой функции.")
+        return
+
+    stats = get_io_stats()
+    await update.message.reply_text(
+        f"Очередь ввода-вывода: {stats['queued']}, выполняется: {stats['running']}\n"
+        f"Выполнено: {stats['completed']}, ошибок: {stats['failed']}\n"
+        f"Ожидание: среднее {stats['wait_avg_ms']} мс, максимум {stats['wait_max_ms']} мс\n"
+        f"Выполнение: среднее {stats['run_avg_ms']} мс"
+    )
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Краткая сводка метрик: самые затратные обработчики и операции хранения."""
+    if context.user_data.get("role") != "Администратор":
+        await update.message.reply_text("У вас нет прав для использования этой функции.")
+        return
+
+    histograms, counters, gauges = _metrics_snapshot()
+
+    def top(metric, label, errors_metric, limit):
+        rows = sorted(
+            ((dict(labels)[label], hist) for (name, labels), hist in histograms.items() if name == metric),
+            key=lambda item: item[1]["sum"], reverse=True
+        )[:limit]
+        lines = []
+        for name, hist in rows:
+            errors = counters.get((errors_metric, ((label, name),)), 0)
+            p95 = histogram_quantile(hist, 0.95)
+            p95_text = f"≤ {p95}" if p95 != float("inf") else f"> {METRICS_BUCKETS[-1]}"
+            lines.append(
+                f"{name}: {hist['count']} выз., среднее {hist['sum'] / hist['count'] * 1000:.0f} мс, p95 {p95_text} с"
+                + (f", ошибок {errors}" if errors else "")
+            )
+        return lines or ["нет данных"]
+
+    log_errors = sum(value for (name, _), value in counters.items() if name == "bot_log_errors_total")
+    await update.message.reply_text(
+        "Обработчики:\n" + "\n".join(top("bot_handler_seconds", "handler", "bot_handler_errors_total", 8))
+        + "\n\nХранилище:\n" + "\n".join(top("bot_storage_seconds", "op", "bot_storage_errors_total", 5))
+        + f"\n\nОжидающих платежей: {gauges.get('bot_pending_payments', 0)}"
+        + f"\nСессий в памяти: {gauges.get('bot_sessions', 0)}"
+        + f"\nОчередь ввода-вывода: {gauges.get('bot_io_queued', 0)}"
+        + f"\nОшибок в журнале: {log_errors}"
+    )
+
+_instrumented_handlers = {}
+
+def instrument_handler(callback):
+    """Обёртка с замером времени в bot_handler_seconds; одна на функцию, повторно не оборачивает."""
+    wrapper = _instrumented_handlers.get(callback)
+    if wrapper is None:
+        wrapper = instrumented("bot_handler", handler=getattr(callback, "__name__", "handler"))(coalesce_replies(callback))
+        _instrumented_handlers[callback] = wrapper
+        _instrumented_handlers[wrapper] = wrapper
+    return wrapper
+
+def instrument_handlers(application):
+    """Оборачивает все зарегистрированные обработчики, включая состояния диалогов и таблицы маршрутов кнопок."""
+    def wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            for inner in handler.entry_points + handler.fallbacks:
+                wrap(inner)
+            for state_handlers in handler.states.values():
+                for inner in state_handlers:
+                    wrap(inner)
+        else:
+            handler.callback = instrument_handler(handler.callback)
+
+    for group in application.handlers.values():
+        for handler in group:
+            wrap(handler)
+    for routes in (BUTTON_ROUTES, CALLBACK_ROUTES):
+        for key, callback in routes.items():
+            routes[key] = instrument_handler(callback)
+    PREFIX_ROUTES[:] = [(prefix, instrument_handler(callback)) for prefix, callback in PREFIX_ROUTES]
+
+async def post_init(application: Application):
+    register_gauge("bot_sessions", "Users with context.user_data loaded in memory", lambda: len(application.user_data))
+    if isinstance(application.bot.rate_limiter, OutgoingRateLimiter):
+        register_gauge("bot_send_queued", "Bot API requests waiting for a rate limit slot",
+                       lambda: application.bot.rate_limiter.waiting)
+    if isinstance(application.update_processor, ChatUpdateProcessor):
+        register_gauge("bot_updates_in_progress", "Updates running or waiting for their chat",
+                       lambda: application.update_processor.backlog)
+    await run_io(_users_registry)
+    await run_io(get_db)
+    await run_io(refresh_menu_data, True, lock=MENU)
+    await run_io(get_menu_index)
+    application.job_queue.run_repeating(refresh_menu_job, interval=MENU_TTL, first=MENU_TTL, name="menu_refresh")
+    schedule_menu_retry(application.job_queue)
+    if WORKER_INDEX in (None, 0):
+        # run_daily без часового пояса считает время в UTC, а CUTOFF_TIME задаётся по местному времени
+        local_tz = datetime.now().astimezone().tzinfo
+        application.job_queue.run_daily(cutoff_job, time=CUTOFF_TIME.replace(tzinfo=local_tz), name="cutoff")
+        # Бот мог быть выключен во время отсечки; уже закрытый день повторно не закрывается
+        application.job_queue.run_once(cutoff_job, when=0, name="cutoff_catchup")
+        application.job_queue.run_repeating(sweep_carts_job, interval=CART_SWEEP_INTERVAL, first=60, name="cart_sweep")
+        # Рассылки, оставшиеся после перезапуска или брошенные упавшим обработчиком (аренда истекла)
+        application.job_queue.run_repeating(resume_broadcasts_job, interval=BROADCAST_LEASE, first=0,
+                                            name="broadcast_resume")
+    # Обработчик слушает свой порт (HTTP_PORT + 1 + номер) для /metrics; уведомления YooKassa принимает диспетчер
+    port = HTTP_PORT if WORKER_INDEX is None else (HTTP_PORT and HTTP_PORT + 1 + WORKER_INDEX)
+    if await start_http_server(port) and YOOKASSA_WEBHOOK:
+        payment_watcher.min_interval = PAYMENT_FALLBACK_POLL_MIN
+        payment_watcher.max_interval = PAYMENT_FALLBACK_POLL_MIN * 2
+    await payment_watcher.start(application.bot)
+    application.job_queue.run_repeating(flush_users_job, interval=USERS_FLUSH_INTERVAL, name="users_flush")
+
+async def post_shutdown(application: Application):
+    await stop_http_server()
+    await payment_watcher.stop()
+    flush_user_data()
+    _io_executor.shutdown(wait=True)
+
+def register_telegram_webhook(application):
+    """Маршрут для обновлений Telegram: проверяет секретный заголовок и кладёт обновление в очередь приложения.
+    Обработка идёт отдельно, поэтому Telegram получает ответ сразу; при переполненной очереди — 503,
+    и Telegram повторит доставку позже."""
+    register_gauge("bot_update_queue_size", "Updates waiting to be processed", application.update_queue.qsize)
+
+    @http_route("POST", TELEGRAM_WEBHOOK_PATH)
+    async def telegram_webhook(request):
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token, TELEGRAM_WEBHOOK_SECRET):
+            return 403, "text/plain", b"forbidden"
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Bad update posted to webhook: {e}")
+            return 400, "text/plain", b"bad update"
+        try:
+            application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            inc("bot_webhook_rejected_total")
+            return 503, "text/plain", b"queue full"
+        inc("bot_webhook_updates_total")
+        return 200, "text/plain", b"ok"
+
+    return telegram_webhook
+
+def _stop_event(signals=(signal.SIGINT, signal.SIGTERM)):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in signals:
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+async def run_without_updater(application, serve):
+    """Аналог run_polling без Updater: тот же порядок post_init / post_shutdown, а обновления
+    в application.update_queue кладёт serve(application), пока не завершится."""
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await serve(application)
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+async def serve_webhook(application):
+    stop_event = _stop_event()
+    if TELEGRAM_WEBHOOK_URL:
+        await application.bot.set_webhook(
+            TELEGRAM_WEBHOOK_URL,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
             allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True
+            drop_pending_updates=True,
+            max_connections=TELEGRAM_WEBHOOK_CONNECTIONS,
         )
+        logger.info(f"Webhook registered at {TELEGRAM_WEBHOOK_URL}")
+    else:
+        logger.warning("TELEGRAM_WEBHOOK_URL is not set, webhook is not registered with Telegram")
+    await stop_event.wait()
+
+# Несколько процессов (WORKERS > 1): диспетчер получает обновления (long polling или webhook) и передаёт
+# каждое в очередь процесса worker_for_chat(chat_id). Обновления одного чата всегда попадают в один процесс
+# и обрабатываются им по порядку. Общие данные — Bot.db (SQLite в режиме WAL), Data.json и Addresses.json
+# под file_lock; фоновые задачи, которые нельзя запускать дважды, выполняет процесс 0
+class WorkerPool:
+    def __init__(self, count):
+        self.count = count
+        self.context = multiprocessing.get_context("spawn")
+        self.inboxes = []
+        self.processes = []
+
+    def _spawn(self, index):
+        process = self.context.Process(target=run_worker, args=(index, self.inboxes[index]), name=f"worker-{index}")
+        process.start()
+        return process
+
+    def start(self):
+        for index in range(self.count):
+            self.inboxes.append(self.context.Queue(maxsize=UPDATE_QUEUE_SIZE))
+            self.processes.append(self._spawn(index))
+        logger.info(f"Started {self.count} worker processes")
+
+    async def forward(self, chat_id, message):
+        index = worker_for_chat(chat_id)
+        if not self.processes[index].is_alive():
+            logger.error(f"Worker {index} exited with code {self.processes[index].exitcode}, restarting")
+            self.processes[index] = self._spawn(index)
+        inbox = self.inboxes[index]
+        try:
+            inbox.put_nowait(message)
+        except queue.Full:
+            # Обработчик не успевает: ждём места, не принимая следующие обновления
+            await asyncio.get_running_loop().run_in_executor(None, inbox.put, message)
+        inc("bot_dispatched_total", worker=str(index))
+
+    async def stop(self):
+        loop = asyncio.get_running_loop()
+        for inbox in self.inboxes:
+            await loop.run_in_executor(None, inbox.put, None)
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, 60)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in time, terminating")
+                process.terminate()
+
+worker_pool = None
+
+async def forward_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat or update.effective_user
+    await worker_pool.forward(chat.id if chat else 0, ("update", update.to_dict()))
+
+async def dispatcher_post_init(application: Application):
+    # Схема и перенос старых данных выполняются один раз, до запуска обработчиков
+    await run_io(get_db)
+    worker_pool.start()
+    await start_http_server()
+
+async def dispatcher_post_shutdown(application: Application):
+    await stop_http_server()
+    await worker_pool.stop()
+    _io_executor.shutdown(wait=True)
+
+def build_dispatcher(updater=True):
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .connect_timeout(30)
+        .read_timeout(30)
+        .write_timeout(30)
+        .pool_timeout(30)
+        .post_init(dispatcher_post_init)
+        .post_shutdown(dispatcher_post_shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None).update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, forward_update))
+    return application
+
+async def serve_worker_inbox(application, inbox):
+    """Передаёт обновления от диспетчера в очередь приложения; None в очереди — сигнал остановки."""
+    stop_event = _stop_event((signal.SIGTERM,))
+    loop = asyncio.get_running_loop()
+    while not stop_event.is_set():
+        try:
+            message = await loop.run_in_executor(None, functools.partial(inbox.get, timeout=1))
+        except queue.Empty:
+            continue
+        if message is None:
+            break
+        kind, payload = message
+        if kind == "update":
+            await application.update_queue.put(Update.de_json(payload, application.bot))
+        elif kind == "payment":
+            application.create_task(check_payment_notification(payload))
+
+def run_worker(index, inbox):
+    """Точка входа процесса-обработчика."""
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    # Ctrl+C получает вся группа процессов; обработчик останавливается, когда диспетчер закроет его очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    application = build_application(updater=False)
+    asyncio.run(run_without_updater(application, functools.partial(serve_worker_inbox, inbox=inbox)))
+
+BUTTON_ROUTES = {
+    "Сделать заказ 🍴": show_menu,
+    "Корзина 🗑": show_cart,
+    "Список заказов": show_all_orders,
+    "Сообщить всем": broadcast_start,
+    "Добавить адрес доставки": add_address_start,
+    "Оплатить картой💳": pay,
+    "Назад 🔙": show_menu,
+    "Нет, спасибо": finish_order,
+    "Вернуться в главное меню": show_main_menu,
+    "Очистить корзину❌": clear_cart,
+    "Выгрузка заказов": import_excel,
+    "Оплатить наличными": handle_payment_selection,
+    "Я согласен ✔": accept_consent,
+    "Отменить заказы на эту дату": handle_cancel,
+}
+PREFIX_ROUTES = [
+    ("Заказать на ", order_for_date),
+]
+# Пока ждём комментарий к корзине, любой текст считается комментарием, кроме этих кнопок
+COMMENT_BYPASS_BUTTONS = {"Сделать заказ 🍴"}
+CALLBACK_ROUTES = {
+    "check": button_callback,  # check_payment_<id>
+}
+
+def build_application(updater=True):
+    # Configure application with proper timeouts and update parameters
+    # Процессы-обработчики делят общий лимит Telegram поровну
+    rate = OUTGOING_RATE / WORKERS if WORKER_INDEX is not None else OUTGOING_RATE
+    bot = ReplyBot(
+        token=TOKEN,
+        request=HTTPXRequest(
+            connection_pool_size=256, connect_timeout=30, read_timeout=30, write_timeout=30, pool_timeout=30
+        ),
+        get_updates_request=HTTPXRequest(connection_pool_size=1),
+        rate_limiter=OutgoingRateLimiter(rate),
+    )
+    builder = (
+        Application.builder()
+        .bot(bot)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .persistence(SQLitePersistence())
+    )
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(ChatUpdateProcessor(CONCURRENT_UPDATES))
+    if not updater:
+        # Обновления кладёт в очередь webhook или диспетчер; очередь ограничена, чтобы при всплеске не копить их без конца
+        builder = builder.updater(None).update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+    application = builder.build()
+
+    registration_handler = ConversationHandler(
+        name="registration",
+        persistent=True,
+        entry_points=[MessageHandler(filters.CONTACT, start)],
+        states={
+            CHOOSE_ADDRESS: [CallbackQueryHandler(choose_address)],
+            ENTER_NAME: [MessageHandler(filters.TEXT, enter_name)],
+        },
+        fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
+    )
+
+    broadcast_handler = ConversationHandler(
+        name="broadcast",
+        persistent=True,
+        entry_points=[MessageHandler(filters.Regex("^Сообщить всем$"), broadcast_start)],
+        states={
+            BROADCAST_MESSAGE: [MessageHandler(filters.TEXT, broadcast_message)],
+        },
+        fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
+    )
+
+    address_handler = ConversationHandler(
+        name="address",
+        persistent=True,
+        entry_points=[MessageHandler(filters.Regex("^Добавить адрес доставки$"), add_address_start)],
+        states={
+            ADD_ADDRESS: [MessageHandler(filters.TEXT, add_address)],
+        },
+        fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
+    )
+
+    # Add handlers
+    application.add_handler(CommandHandler("start", under_start))
+    application.add_handler(CommandHandler("refresh_menu", refresh_menu_command))
+    application.add_handler(CommandHandler("io_stats", io_stats_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("orders", show_all_orders))
+    application.add_handler(CommandHandler("export", import_excel))
+    application.add_handler(registration_handler)
+    application.add_handler(broadcast_handler)
+    application.add_handler(address_handler)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
+    application.add_handler(CallbackQueryHandler(route_callback))
+    instrument_handlers(application)
+    return application
+
+def main():
+    global worker_pool
+    try:
+        if WORKERS > 1:
+            worker_pool = WorkerPool(WORKERS)
+            application = build_dispatcher(updater=UPDATES_MODE != "webhook")
+        else:
+            application = build_application(updater=UPDATES_MODE != "webhook")
+
+        if UPDATES_MODE == "webhook":
+            register_telegram_webhook(application)
+            asyncio.run(run_without_updater(application, serve_webhook))
+        else:
+            # Start the bot with proper polling configuration
+            application.run_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
     except Exception as e:
         logger.error(f"Ошибка в main: {e}")
         raise